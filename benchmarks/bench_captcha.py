@@ -0,0 +1,72 @@
+"""
+驗證碼辨識基準測試
+
+對一個已標註的驗證碼圖片資料夾 (檔名即答案，例如 ab12.png 或 ab12_003.png)，
+比較「單次 ocr.classification」(舊作法) 與「多版本前處理 + 信心排序」(新作法)
+的辨識正確率與 p50/p95 耗時。
+
+用法:
+    python benchmarks/bench_captcha.py path/to/captchas
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import sync_module  # noqa: E402
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp')
+
+
+def _load_samples(folder):
+    samples = []
+    for name in sorted(os.listdir(folder)):
+        stem, ext = os.path.splitext(name)
+        if ext.lower() not in IMAGE_EXTENSIONS:
+            continue
+        with open(os.path.join(folder, name), 'rb') as f:
+            samples.append((stem.split('_')[0], f.read()))
+    return samples
+
+
+def _percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def _run(label, samples, solve):
+    correct = 0
+    latencies = []
+    for answer, img_bytes in samples:
+        start = time.perf_counter()
+        guess = solve(img_bytes)
+        latencies.append(time.perf_counter() - start)
+        correct += guess.strip().lower() == answer.lower()
+    print(
+        f"{label:<8} 正確率={correct / len(samples):.1%} ({correct}/{len(samples)}) "
+        f"p50={_percentile(latencies, 50) * 1000:.1f}ms p95={_percentile(latencies, 95) * 1000:.1f}ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='驗證碼辨識基準測試')
+    parser.add_argument('folder', help='已標註的驗證碼圖片資料夾，檔名 (底線前) 為正確答案')
+    parser.add_argument('--length', type=int, default=sync_module.CAPTCHA_LENGTH, help='驗證碼長度限制')
+    args = parser.parse_args()
+
+    samples = _load_samples(args.folder)
+    if not samples:
+        print(f"{args.folder} 中沒有驗證碼圖片。")
+        return
+    sync_module.CAPTCHA_LENGTH = args.length
+    ocr = sync_module.get_ocr()
+    ocr.classification(samples[0][1])  # 預熱模型，避免第一張圖片的耗時計入
+
+    _run('before', samples, ocr.classification)
+    _run('after', samples, lambda img_bytes: sync_module.solve_captcha(img_bytes, ocr))
+
+
+if __name__ == '__main__':
+    main()
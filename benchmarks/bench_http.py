@@ -0,0 +1,81 @@
+"""
+HTTP 連線池基準測試
+
+在本機啟動一個模擬 ajax_list.php 的 HTTP 伺服器，分別以
+「每次 requests.post」(舊作法) 與「共用連線池 Session」(新作法) 執行 sync_data，
+比較每次執行的連線(握手)次數與 p50/p95 延遲。
+
+用法:
+    python benchmarks/bench_http.py --tasks 500 --workers 5 --latency 0.01
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import sync_module  # noqa: E402
+from standins import api_url, start_api_server  # noqa: E402
+
+
+def _percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def _run(label, server, tasks, workers, use_pool):
+    server.connections = 0
+    sync_module.close_http_session()
+    original = sync_module.get_http_session
+    if not use_pool:
+        # 以 requests 模組取代 Session，重現每次 requests.post 的舊行為
+        sync_module.get_http_session = lambda: requests
+    latencies = []
+
+    def one(item):
+        start = time.perf_counter()
+        sync_module.sync_data(item, 'bench=1')
+        latencies.append(time.perf_counter() - start)
+
+    items = [
+        {'salesregid': f'B{i:06d}', 'finish_start_date': 0, 'finish_end_date': 1, 'nTotalComplete': 0}
+        for i in range(tasks)
+    ]
+    started = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(one, items))
+    finally:
+        sync_module.get_http_session = original
+        sync_module.close_http_session()
+    elapsed = time.perf_counter() - started
+    print(
+        f"{label:<8} 連線數={server.connections:<6} "
+        f"p50={_percentile(latencies, 50) * 1000:.1f}ms p95={_percentile(latencies, 95) * 1000:.1f}ms "
+        f"總耗時={elapsed:.2f}s"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='HTTP 連線池基準測試')
+    parser.add_argument('--tasks', type=int, default=500)
+    parser.add_argument('--workers', type=int, default=sync_module.MAX_WORKERS)
+    parser.add_argument('--latency', type=float, default=0.01, help='模擬伺服器延遲 (秒)')
+    args = parser.parse_args()
+
+    server = start_api_server(args.latency)
+    sync_module.API_URL = api_url(server)
+    sync_module.configure_rate_limiter(initial_rate=10000, max_rate=10000)  # 只比較連線方式，不受速率控制影響
+    try:
+        _run('before', server, args.tasks, args.workers, use_pool=False)
+        _run('after', server, args.tasks, args.workers, use_pool=True)
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+sync_module 冷啟動 (import) 基準測試
+
+以 `python -X importtime` 在全新的子程序中匯入 sync_module，輸出累計匯入耗時與最重的模組；
+指定 --baseline 時，另將該 git 版本的 sync_module.py 匯出到暫存資料夾比較前後差異。
+
+用法:
+    python benchmarks/bench_import.py --baseline HEAD~1 --runs 5
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _import_times(module_dir):
+    """回傳 {模組名稱: 累計匯入耗時 (微秒)}"""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import sync_module'],
+        cwd=module_dir, capture_output=True, text=True, check=True
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line.split('|')
+        try:
+            times[name.strip()] = int(cumulative)
+        except ValueError:
+            continue  # 標題列
+    return times
+
+
+def _measure(label, module_dir, runs, top):
+    samples = [_import_times(module_dir) for _ in range(runs)]
+    totals = [sample['sync_module'] for sample in samples]
+    print(f"{label:<10} import sync_module 中位數={statistics.median(totals) / 1000:.1f}ms "
+          f"(最小 {min(totals) / 1000:.1f}ms，{runs} 次)")
+    last = samples[-1]
+    heaviest = sorted(
+        ((us, name) for name, us in last.items() if name != 'sync_module' and '.' not in name),
+        reverse=True
+    )[:top]
+    for us, name in heaviest:
+        print(f"           {name:<24} {us / 1000:8.1f}ms")
+    return statistics.median(totals)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='sync_module 冷啟動基準測試')
+    parser.add_argument('--baseline', help='比較用的 git 版本 (例如 HEAD~1)')
+    parser.add_argument('--runs', type=int, default=5, help='每個版本量測次數')
+    parser.add_argument('--top', type=int, default=8, help='列出最耗時的頂層模組數')
+    args = parser.parse_args()
+
+    before = None
+    if args.baseline:
+        source = subprocess.run(
+            ['git', 'show', f'{args.baseline}:sync_module.py'],
+            cwd=ROOT, capture_output=True, check=True
+        ).stdout
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, 'sync_module.py'), 'wb') as f:
+                f.write(source)
+            before = _measure('before', tmp, args.runs, args.top)
+    after = _measure('after', ROOT, args.runs, args.top)
+    if before:
+        print(f"冷啟動減少 {(before - after) / 1000:.1f}ms ({(before - after) / before:.0%})")
+
+
+if __name__ == '__main__':
+    main()
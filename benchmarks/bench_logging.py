@@ -0,0 +1,132 @@
+"""
+每個任務的日誌開銷基準測試
+
+以多個執行緒反覆執行單一任務的資料庫寫入函式 (delete_details、insert_details、update_summary，
+游標為不做事的替身)，比較下列設定下每個任務在工作執行緒中花費的時間：
+    none      關閉日誌 (基準)
+    before    舊作法：basicConfig 的 FileHandler + StreamHandler，在工作執行緒中同步寫入
+    full      configure_logging('full')：QueueHandler + 背景 QueueListener
+    summary   configure_logging('summary')：只保留摘要，每個任務的細節不輸出
+
+控制台輸出預設導向 os.devnull，加上 --console 則實際寫到 stderr。
+
+用法:
+    python benchmarks/bench_logging.py --tasks 2000 --workers 5 --rows 10
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import sync_module  # noqa: E402
+
+
+class _NullCursor:
+    def execute(self, stmt, params=None):
+        pass
+
+    def executemany(self, stmt, params):
+        pass
+
+
+def _percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def _configure_before(log_path):
+    """重現舊版 logging.basicConfig 的同步設定"""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[logging.FileHandler(log_path, encoding='utf-8'), logging.StreamHandler()],
+        force=True
+    )
+    sync_module.task_log.setLevel(logging.INFO)
+
+
+def _reset():
+    sync_module.stop_logging()
+    logging.disable(logging.NOTSET)
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+
+
+def _run(label, tasks, workers, rows):
+    item = {'salesregid': 'B000001', 'cClassYM': '2024', 'dTrainBeginDate': '2024-01-01', 'dTrainEndDate': '2024-12-31'}
+    api_rows = [{'fullname': f'課程 {i}', 'finish_time': 1704038400 + i} for i in range(rows)]
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(count):
+        cursor = _NullCursor()
+        local = []
+        for _ in range(count):
+            started = time.perf_counter()
+            sync_module.delete_details(cursor, item)
+            sync_module.insert_details(cursor, item, api_rows)
+            sync_module.update_summary(cursor, item, rows)
+            local.append(time.perf_counter() - started)
+        with lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=worker, args=(tasks // workers,)) for _ in range(workers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    mean = sum(latencies) / len(latencies)
+    print(f"{label:<8} 每任務平均={mean * 1e6:8.1f}µs p95={_percentile(latencies, 95) * 1e6:8.1f}µs "
+          f"總耗時={elapsed:.3f}s")
+    return mean
+
+
+def main():
+    parser = argparse.ArgumentParser(description='每個任務的日誌開銷基準測試')
+    parser.add_argument('--tasks', type=int, default=2000)
+    parser.add_argument('--workers', type=int, default=sync_module.MAX_WORKERS)
+    parser.add_argument('--rows', type=int, default=10, help='每個任務新增的明細筆數')
+    parser.add_argument('--console', action='store_true', help='控制台輸出實際寫到 stderr')
+    args = parser.parse_args()
+
+    original_stderr = sys.stderr
+    devnull = open(os.devnull, 'w', encoding='utf-8')
+    if not args.console:
+        sys.stderr = devnull  # StreamHandler 在建立時綁定 sys.stderr
+    results = {}
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            sync_module.LOG_FILE = os.path.join(tmp, 'sync.log')
+
+            _reset()
+            logging.disable(logging.CRITICAL)
+            results['none'] = _run('none', args.tasks, args.workers, args.rows)
+
+            _reset()
+            _configure_before(os.path.join(tmp, 'before.log'))
+            results['before'] = _run('before', args.tasks, args.workers, args.rows)
+
+            for verbosity in ('full', 'summary'):
+                _reset()
+                sync_module.configure_logging(verbosity)
+                results[verbosity] = _run(verbosity, args.tasks, args.workers, args.rows)
+            _reset()
+    finally:
+        sys.stderr = original_stderr
+        devnull.close()
+
+    for label in ('before', 'full', 'summary'):
+        print(f"{label:<8} 日誌開銷={max(0.0, results[label] - results['none']) * 1e6:8.1f}µs/任務")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+"""
+同步流程吞吐量基準測試
+
+以本機替身取代 TII API 與 SQL Server (見 standins.py)，在不同任務數、工作執行緒數、
+執行模式與寫入方式下執行完整的 run_sync，輸出 tasks/sec、單一任務 p95 延遲 (第一次派發到最終結果)、
+API 請求數與資料庫往返次數，用於離線驗證效能變化。
+
+用法:
+    python benchmarks/bench_pipeline.py --tasks 200,1000 --workers 1,5,10 --modes thread,async,pipeline \
+        --write-modes row,bulk --latency 0.02 --rows 20 --error-rate 0.01 --db-latency 0.001 --write-workers 2
+    python benchmarks/bench_pipeline.py --tasks 1000 --rows 200 --unchanged 0.9 --count-probe
+    python benchmarks/bench_pipeline.py --tasks 50 --rows 2000 --row-latency 0.0005 --fetch-strategies single,pages,windows
+
+pipeline 模式下 --workers 為抓取執行緒數，寫入執行緒數由 --write-workers 指定，
+並另外輸出兩段的使用率與抓取端因寫入佇列已滿而等待的時間。
+"""
+import argparse
+import itertools
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import sync_module  # noqa: E402
+from standins import FakeDatabase, api_url, make_tasks, start_api_server  # noqa: E402
+
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def _csv(cast):
+    return lambda value: [cast(part) for part in value.split(',') if part]
+
+
+def _timed_task_handlers(latencies):
+    """
+    記錄每個任務從第一次派發到最終結果的耗時，回傳還原函式。
+    各模式都以第一次呼叫任務處理函式為起點、以 _record_checkpoint 記錄結果為終點，
+    因此重試等待與批次寫入的提交延遲都會計入，不同模式與寫入方式的 p95 可以直接比較。
+    """
+    original_sync = sync_module.process_single_task
+    original_async = sync_module._async_process_single_task
+    original_fetch = sync_module._fetch_stage
+    original_record = sync_module._record_checkpoint
+    started = {}
+
+    def dispatched(item):
+        started.setdefault(item['salesregid'], time.perf_counter())
+
+    def process_single_task(item, session, attempt=1):
+        dispatched(item)
+        return original_sync(item, session, attempt)
+
+    async def async_process_single_task(item, session, client, db_executor, attempt=1):
+        dispatched(item)
+        return await original_async(item, session, client, db_executor, attempt)
+
+    def fetch_stage(item, session, attempt=1):
+        dispatched(item)
+        return original_fetch(item, session, attempt)
+
+    def record_checkpoint(item, ok):
+        first = started.pop(item['salesregid'], None)
+        if first is not None:
+            latencies.append(time.perf_counter() - first)
+        original_record(item, ok)
+
+    sync_module.process_single_task = process_single_task
+    sync_module._async_process_single_task = async_process_single_task
+    sync_module._fetch_stage = fetch_stage
+    sync_module._record_checkpoint = record_checkpoint
+
+    def restore():
+        sync_module.process_single_task = original_sync
+        sync_module._async_process_single_task = original_async
+        sync_module._fetch_stage = original_fetch
+        sync_module._record_checkpoint = original_record
+    return restore
+
+
+def _run(server, db, mode, write_mode, workers, fetch_strategy, args):
+    server.requests = server.errors = server.connections = server.bytes_sent = 0
+    db.round_trips = 0
+    sync_module.close_http_session()
+    sync_module.close_db_pool()
+    argv = [
+        '--mode', mode, '--write-mode', write_mode, '--max-attempts', str(args.max_attempts),
+        '--workers', str(workers), '--concurrency', str(workers),
+        '--fetch-workers', str(workers), '--write-workers', str(args.write_workers),
+        '--initial-rate', str(args.rate), '--max-rate', str(args.rate),
+        '--metrics-json', '', '--metrics-prom', '',
+        '--checkpoint-file', ''  # 不讀寫正式的續傳紀錄檔
+    ]
+    if args.count_probe:
+        argv.append('--count-probe')
+    argv += ['--fetch-strategy', fetch_strategy]
+    latencies = []
+    restore = _timed_task_handlers(latencies)
+    started = time.perf_counter()
+    try:
+        run_args = sync_module._parse_args(argv)
+        sync_module.configure_run(run_args)
+        sync_module.run_sync(run_args)
+    finally:
+        restore()
+    elapsed = time.perf_counter() - started
+    snapshot = sync_module.get_metrics().snapshot()
+    counters = snapshot['counters']
+    print(
+        f"{mode:<8} {write_mode:<5} {fetch_strategy:<7} tasks={len(db.tasks):<6} workers={workers:<4} "
+        f"tasks/s={len(db.tasks) / elapsed:8.1f} p95={_percentile(latencies, 95) * 1000:7.1f}ms "
+        f"成功={counters.get('tasks_succeeded', 0):<6} API請求={server.requests:<6} "
+        f"API錯誤={server.errors:<5} 重試後放棄={counters.get('retries_gave_up', 0):<4} "
+        f"連線數={server.connections:<4} DB往返={db.round_trips} API回應={server.bytes_sent / 1024:.0f}KiB"
+    )
+    if counters.get('count_probes'):
+        print(
+            f"{'':<8} probe={counters['count_probes']} 略過下載={counters.get('count_probe_skips', 0)} "
+            f"需完整下載={counters.get('count_probe_misses', 0)} "
+            f"估計節省={counters.get('count_probe_bytes_saved', 0) / 1024:.0f}KiB "
+            f"未命中成本={counters.get('count_probe_bytes_wasted', 0) / 1024:.0f}KiB "
+            f"淨節省={(counters.get('count_probe_bytes_saved', 0) - counters.get('count_probe_bytes_wasted', 0)) / 1024:.0f}KiB"
+        )
+    if counters.get('fetch_parts'):
+        print(
+            f"{'':<8} 分頁查詢={counters.get('fetch_pages', 0)} 切分期間={counters.get('fetch_windows', 0)} "
+            f"分段數={counters['fetch_parts']} 改為一次查詢={counters.get('fetch_split_fallbacks', 0)}"
+        )
+    gauges = snapshot['gauges']
+    if mode == 'pipeline':
+        print(
+            f"{'':<8} 抓取使用率={gauges['pipeline_fetch_utilisation']:.0%} "
+            f"寫入使用率={gauges['pipeline_write_utilisation']:.0%} "
+            f"抓取等待寫入={gauges['pipeline_fetch_blocked_seconds']:.2f}s "
+            f"佇列峰值={gauges['pipeline_write_queue_peak']}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='同步流程吞吐量基準測試')
+    parser.add_argument('--tasks', type=_csv(int), default=[200], help='任務數，可用逗號分隔多個值')
+    parser.add_argument('--workers', type=_csv(int), default=[sync_module.MAX_WORKERS],
+                        help='工作執行緒數 (async 模式為同時進行中的任務上限)，可用逗號分隔多個值')
+    parser.add_argument('--modes', type=_csv(str), default=['thread'], help='執行模式：thread,async,pipeline')
+    parser.add_argument('--write-workers', type=int, default=sync_module.PIPELINE_WRITE_WORKERS,
+                        help='pipeline 模式的資料庫寫入執行緒數')
+    parser.add_argument('--write-modes', type=_csv(str), default=['row'], help='寫入方式：row,diff,bulk')
+    parser.add_argument('--latency', type=float, default=0.01, help='模擬 API 延遲 (秒)')
+    parser.add_argument('--rows', type=int, default=10, help='每個任務回傳的明細筆數')
+    parser.add_argument('--row-latency', type=float, default=0.0, help='每筆回傳明細額外的模擬 API 延遲 (秒)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='API 回傳錯誤的比例 (0~1)')
+    parser.add_argument('--error-status', type=int, default=500, help='API 錯誤回應的 HTTP 狀態碼')
+    parser.add_argument('--fetch-strategies', type=_csv(str), default=['auto'],
+                        help='明細查詢方式：auto,single,pages,windows')
+    parser.add_argument('--unchanged', type=float, default=0.0,
+                        help='資料庫數量已與 API 相同 (資料未變化) 的任務比例 (0~1)')
+    parser.add_argument('--count-probe', action='store_true', help='啟用 count probe')
+    parser.add_argument('--ignore-paging', action='store_true', help='模擬忽略 limit/offset 的 API')
+    parser.add_argument('--db-latency', type=float, default=0.0, help='每次資料庫往返的模擬延遲 (秒)')
+    parser.add_argument('--max-attempts', type=int, default=sync_module.RETRY_MAX_ATTEMPTS,
+                        help='暫時性失敗時單一任務最多嘗試次數')
+    parser.add_argument('--rate', type=float, default=10000.0, help='API 速率上限 (每秒請求數)，預設等同不限速')
+    args = parser.parse_args()
+
+    logging.disable(logging.ERROR)  # 模擬的 API 錯誤屬預期內，不輸出同步日誌
+    server = start_api_server(args.latency, args.rows, args.error_rate, args.error_status,
+                              paginate=not args.ignore_paging, row_latency=args.row_latency)
+    sync_module.API_URL = api_url(server)
+    sync_module.ensure_session = lambda: 'bench=1'
+    state_dir = tempfile.mkdtemp(prefix='bench_pipeline_')
+    sync_module.STATE_DB_FILE = os.path.join(state_dir, 'sync_state.db')
+    db = FakeDatabase([], args.db_latency)
+    sync_module.pymssql.connect = lambda **kwargs: db.connect()
+    try:
+        grid = itertools.product(args.tasks, args.modes, args.write_modes, args.workers, args.fetch_strategies)
+        for tasks, mode, write_mode, workers, fetch_strategy in grid:
+            db.tasks = make_tasks(tasks, args.unchanged, args.rows)
+            _run(server, db, mode, write_mode, workers, fetch_strategy, args)
+    finally:
+        sync_module.close_http_session()
+        sync_module.close_db_pool()
+        sync_module.close_state_store()
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+"""
+基準測試用的本機替身
+
+- start_api_server: 模擬 ajax_list.php?api=complete_status_company_detail 的 HTTP 伺服器，
+  可設定延遲、每個任務回傳的明細筆數與錯誤率，支援 limit/offset 分頁 (可關閉以模擬忽略分頁參數的伺服器)，
+  並統計連線數、請求數與回應位元組數。
+- FakeDatabase: 模擬 pymssql 連線，回應任務查詢並統計資料庫往返次數
+  (pymssql 的 executemany 逐列執行，每列計為一次往返)。
+"""
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+TASKS_TABLE_MARKER = 'FROM NYDB.AT.InsuExternalTrainingX A'
+FIRST_FINISH_TIME = 1704038400  # 模擬任務查詢期間的起訖時間，明細的完訓時間平均分布其中
+LAST_FINISH_TIME = 1735660799
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # 支援 keep-alive
+    disable_nagle_algorithm = True  # 避免 keep-alive 連線上的 Nagle + delayed ACK 延遲
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        form = parse_qs(self.rfile.read(length).decode('utf-8'))
+        time.sleep(self.server.latency)
+        with self.server.lock:
+            self.server.requests += 1
+            failed = self.server.rng.random() < self.server.error_rate
+            if failed:
+                self.server.errors += 1
+        if failed:
+            self._reply(self.server.error_status, b'error', 'text/plain')
+            return
+        salesregid = form.get('salesregid', [''])[0]
+        start = int(form.get('finish_start_date', ['0'])[0])
+        end = int(form.get('finish_end_date', ['0'])[0])
+        step = (LAST_FINISH_TIME - FIRST_FINISH_TIME) // max(1, self.server.rows)
+        rows = [
+            {'fullname': f'{salesregid} 課程 {i:04d}', 'finish_time': FIRST_FINISH_TIME + i * step}
+            for i in range(self.server.rows)
+        ]
+        rows = [row for row in rows if start <= row['finish_time'] <= end]
+        total = len(rows)
+        if self.server.paginate and 'limit' in form:
+            offset = int(form.get('offset', ['0'])[0])
+            rows = rows[offset:offset + int(form['limit'][0])]
+        time.sleep(self.server.row_latency * len(rows))
+        body = json.dumps({'total': total, 'rows': rows}, ensure_ascii=False).encode('utf-8')
+        self._reply(200, body, 'application/json')
+
+    def _reply(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        with self.server.lock:
+            self.server.bytes_sent += len(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        pass  # 用戶端關閉連線池時的連線中斷屬正常情況
+
+
+def start_api_server(latency: float = 0.01, rows: int = 0, error_rate: float = 0.0,
+                     error_status: int = 500, seed: int = 0, paginate: bool = True,
+                     row_latency: float = 0.0) -> ThreadingHTTPServer:
+    """
+    在背景執行緒啟動模擬 API 伺服器，使用完畢後呼叫 server.shutdown()
+    :param latency: 每個請求的延遲 (秒)
+    :param rows: 每個任務回傳的明細筆數
+    :param error_rate: 回傳 error_status 的比例 (0~1)
+    :param error_status: 錯誤回應的 HTTP 狀態碼
+    :param seed: 錯誤抽樣的亂數種子，讓每次執行可重現
+    :param paginate: 是否套用 limit/offset 分頁參數
+    :param row_latency: 每筆回傳明細額外增加的延遲 (秒)，模擬大量明細的查詢與序列化成本
+    """
+    server = _StandInServer(('127.0.0.1', 0), _StandInHandler)
+    server.lock = threading.Lock()
+    server.connections = 0
+    server.requests = 0
+    server.errors = 0
+    server.bytes_sent = 0
+    server.latency = latency
+    server.rows = rows
+    server.error_rate = error_rate
+    server.error_status = error_status
+    server.rng = random.Random(seed)
+    server.paginate = paginate
+    server.row_latency = row_latency
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def api_url(server: ThreadingHTTPServer) -> str:
+    return f'http://127.0.0.1:{server.server_address[1]}/moodle/company/ajax_list.php?api=complete_status_company_detail'
+
+
+def make_tasks(count: int, unchanged: float = 0.0, rows: int = 0):
+    """
+    產生 fetch_tasks 格式的任務
+    :param unchanged: nTotalComplete 已等於 API 明細數 (資料未變化) 的任務比例，其餘比 API 少一筆
+    :param rows: API 回傳的明細筆數
+    """
+    synced = int(count * unchanged)
+    return [
+        {
+            'salesregid': f'B{i:06d}',
+            'finish_start_date': FIRST_FINISH_TIME,
+            'finish_end_date': LAST_FINISH_TIME,
+            'dTrainBeginDate': '2024-01-01',
+            'dTrainEndDate': '2024-12-31',
+            'nTotalComplete': rows if i < synced else max(0, rows - 1),
+            'cClassYM': '2024',
+            'cRegNumber': f'R{i:06d}'
+        }
+        for i in range(count)
+    ]
+
+
+class FakeDatabase:
+    """共用的假資料庫：保存任務清單並統計所有連線的往返次數"""
+
+    def __init__(self, tasks, latency: float = 0.0):
+        self.tasks = tasks
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.round_trips = 0
+        self.connections = 0
+
+    def connect(self):
+        with self.lock:
+            self.connections += 1
+        return _FakeConnection(self)
+
+    def round_trip(self, count: int = 1):
+        with self.lock:
+            self.round_trips += count
+        if self.latency:
+            time.sleep(self.latency * count)
+
+
+class _FakeConnection:
+    def __init__(self, db: FakeDatabase):
+        self._db = db
+
+    def cursor(self, as_dict: bool = False):
+        return _FakeCursor(self._db)
+
+    def autocommit(self, value: bool):
+        pass
+
+    def commit(self):
+        self._db.round_trip()
+
+    def rollback(self):
+        self._db.round_trip()
+
+    def close(self):
+        pass
+
+
+class _FakeCursor:
+    def __init__(self, db: FakeDatabase):
+        self._db = db
+        self._rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def execute(self, stmt, params=None):
+        self._db.round_trip()
+        if TASKS_TABLE_MARKER in stmt:
+            self._rows = [dict(task) for task in self._db.tasks]
+        elif stmt.strip().upper().startswith('SELECT 1'):
+            self._rows = [(1,)]
+        else:
+            self._rows = []
+
+    def executemany(self, stmt, params):
+        self._db.round_trip(len(params))
+        self._rows = []
+
+    def fetchone(self):
+        return self._rows.pop(0) if self._rows else None
+
+    def fetchmany(self, size):
+        chunk, self._rows = self._rows[:size], self._rows[size:]
+        return chunk
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
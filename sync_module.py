@@ -1,22 +1,47 @@
 
 import os
+import argparse
+import asyncio
+import hashlib
+import io
+import gzip
+import json
 import logging
+import shutil
+import itertools
+import queue
+import signal
+import threading
+from collections import Counter, deque
 from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from html.parser import HTMLParser
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
+from urllib.parse import urljoin
 import pymssql
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import MaxRetryError, ReadTimeoutError
+from urllib3.util.retry import Retry
 import time
 import random
-from typing import List, Dict, Optional, Any
-from playwright.sync_api import sync_playwright, TimeoutError as PlaywrightTimeoutError
-import ddddocr
-from dotenv import load_dotenv
-
-load_dotenv() # 載入 .env 檔案中的環境變數
+import re
+import sqlite3
+from typing import List, Dict, Optional, Any, Callable, Iterable, Iterator, Sequence, Tuple
+# playwright、ddddocr (onnxruntime) 只在需要登入時才載入，見 BrowserLoginClient 與 get_ocr
 
 # --- 全域常數設定 (Global Constants) ---
 # 檔案相關
-COOKIE_FILE = 'tii_elearning_cookies.txt'
+COOKIE_FILE = 'tii_elearning_cookies.txt'  # 舊版純文字 Cookie 檔案，讀取時自動轉換
+SESSION_FILE = 'tii_elearning_session.json'
+SESSION_VERIFY_TTL = 600  # 最近驗證過的 session 在此秒數內不再探測
+STATE_DB_FILE = 'sync_state.db'  # 本機同步狀態 (增量同步高水位等)
+SESSION_REPLAY_LIMIT = 2  # 單一任務因 session 失效而重新登入後重試的次數上限
 LOG_FILE = 'sync.log'
+LOG_MAX_BYTES = 10 * 1024 * 1024  # 日誌檔超過此大小時輪替 (--log-rotation size)
+LOG_BACKUP_COUNT = 10             # 保留的壓縮舊日誌數
+LOG_ROTATION = 'size'             # size: 依大小輪替；daily: 每日午夜輪替
 
 # URL 相關
 BASE_URL = 'https://elearning.tii.org.tw'
@@ -30,62 +55,818 @@ CAPTCHA_IMG_SELECTOR = '#captcha_img'
 CAPTCHA_CODE_SELECTOR = '#captcha_code'
 SIGNIN_BUTTON_SELECTOR = '.btn-signin'
 ERROR_ALERT_SELECTOR = '.alert.alert-danger'
+LOGIN_RESULT_TIMEOUT = 5        # 送出登入表單後等待結果的秒數
+LOGIN_RETRY_DELAY = (0.5, 1.5)  # 登入失敗後重試前的等待秒數範圍
+CAPTCHA_LENGTH = None           # 已知驗證碼長度時設定，長度不符的候選答案會被降分
+CAPTCHA_CHARSET = r'[0-9A-Za-z]+'  # 驗證碼允許的字元
+CAPTCHA_INVALID_PENALTY = 0.1   # 不符長度/字元限制的候選答案分數乘數
+CAPTCHA_ACCEPT_CONFIDENCE = 0.9 # 原圖辨識信心達到此值且符合限制時直接採用
+LOGIN_BACKEND = 'auto'          # http: 只用 HTTP 表單登入；browser: 只用 Playwright；auto: 先 HTTP 再退回 Playwright
+
+# 資料時區 (fetch_tasks 以 UTC+8 換算 finish_start_date / finish_end_date)
+LOCAL_TZ = timezone(timedelta(hours=8))
 
 # 執行緒與超時設定
 MAX_WORKERS = 5
 REQUEST_TIMEOUT = 30
+ASYNC_CONCURRENCY = 100  # async 模式下同時進行中的任務上限
+FETCH_CHUNK_SIZE = 200   # fetch_tasks 每次從游標讀取的筆數
+TASK_QUEUE_SIZE = MAX_WORKERS * 4  # 工作佇列上限，讀取速度超過處理速度時暫停讀取
+
+# HTTP 連線池設定
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64)'
+HTTP_POOL_CONNECTIONS = 1          # 只連線 elearning.tii.org.tw 一個主機
+HTTP_POOL_MAXSIZE = MAX_WORKERS    # 每個主機保留的 keep-alive 連線數，與工作執行緒數一致
+HTTP_MAX_RETRIES = 3               # 只重試建立連線失敗；逾時與 5xx 交由任務層級重試 (--max-attempts)
+HTTP_BACKOFF_FACTOR = 0.5
+
+# 自適應速率控制設定 (token bucket + AIMD)
+RATE_INITIAL = 2.0               # 初始每秒請求數
+RATE_MIN = 0.2                   # 退避後的最低每秒請求數
+RATE_MAX = 20.0                  # 每秒請求數上限
+RATE_BURST = MAX_WORKERS         # token bucket 容量
+RATE_INCREASE_STEP = 0.1         # 每次快速成功回應後增加的每秒請求數
+RATE_DECREASE_FACTOR = 0.5       # 逾時、429、5xx 或回應過慢時的乘法退避係數
+RATE_DECREASE_COOLDOWN = 2.0     # 兩次退避之間的最短間隔 (秒)，避免同一波失敗重複退避
+RATE_SLOW_RESPONSE = 5.0         # 回應時間超過此秒數視為伺服器變慢
+
+# 批次寫入設定 (--write-mode bulk)
+WRITE_BATCH_TASKS = 50                 # 累積多少個任務後寫入一次
+WRITE_BATCH_ROWS = 5000                # 或累積多少筆明細後寫入一次
+BULK_INSERT_ROWS_PER_STATEMENT = 500   # 單一 INSERT ... VALUES 的列數 (SQL Server 上限 1000)
+WRITE_BATCH_ATTEMPTS = 2               # 批次遇到死結或連線中斷時最多嘗試次數 (含第一次)
+
+# 增量同步設定 (--incremental)
+INCREMENTAL_FULL_SYNC_INTERVAL = 86400  # 距上次完整同步超過此秒數時改為完整同步，以校正上游刪除的紀錄
+
+# API 分頁參數 (回應的 total/rows 格式為 bootstrap-table 伺服器端分頁，預設以 limit/offset 取得部分明細)
+API_LIMIT_FIELD = 'limit'
+API_OFFSET_FIELD = 'offset'
+
+# 大量明細分段查詢設定 (--fetch-strategy)
+LARGE_FETCH_ROWS = 500   # 上次同步的明細數達到此值時改為分段查詢 (auto)
+FETCH_PAGE_SIZE = 200    # 分頁查詢每頁筆數；切分時間區間時以此估計段數
+FETCH_MAX_PARTS = 8      # 單一任務同時查詢的分段數上限
+
+# API 回應指紋快取設定 (--fingerprint)
+FINGERPRINT_CACHE_SIZE = 100000  # 最多保留的指紋筆數
+FINGERPRINT_EVICT_EVERY = 1000   # 每寫入多少筆檢查一次是否需要淘汰
+
+# 資料庫連線池設定
+DB_POOL_MIN_SIZE = 1                  # 閒置回收時至少保留的連線數
+DB_POOL_MAX_SIZE = MAX_WORKERS + 1    # 工作執行緒 + fetch_tasks
+DB_POOL_IDLE_TIMEOUT = 300            # 閒置超過此秒數的連線會被關閉
+DB_POOL_HEALTH_CHECK_AFTER = 30       # 閒置超過此秒數的連線在借出前先做健康檢查
+DB_POOL_ACQUIRE_TIMEOUT = 60          # 等待可用連線的最長秒數
+
+# 中斷續傳設定
+CHECKPOINT_FILE = 'sync_checkpoint.jsonl'  # 本次執行已完成任務的紀錄，執行完成後刪除
+CHECKPOINT_FSYNC_EVERY = 50                # 每寫入多少筆紀錄 fsync 一次
+CHECKPOINT_FSYNC_INTERVAL = 1.0            # 或距上次 fsync 超過此秒數
+CHECKPOINT_MAX_AGE = 86400                 # 超過此秒數的中斷紀錄不再續傳
+
+# 暫時性失敗重試設定
+RETRY_MAX_ATTEMPTS = 3                         # 單一任務最多嘗試次數 (含第一次)
+RETRY_BASE_DELAY = 1.0                         # 第一次重試前的等待秒數，之後每次加倍
+RETRY_MAX_DELAY = 30.0                         # 重試等待秒數上限
+TRANSIENT_FAILURES = ('timeout', 'connection', 'server_error', 'deadlock')  # 可重試的失敗類別
+DB_DEADLOCK_ERRORS = (1205, 1222)              # SQL Server 死結犧牲者、鎖定逾時
+DB_CONNECTION_ERRORS = (20003, 20006, 20009, 20047)  # FreeTDS 逾時、寫入失敗、無法連線、連線已中斷
+
+# 兩段式管線設定 (--mode pipeline)
+PIPELINE_WRITE_WORKERS = 2   # 寫入資料庫的執行緒數
+PIPELINE_QUEUE_SIZE = 50     # 抓取與寫入之間的佇列上限，寫入變慢時抓取端隨之暫停
+
+# 常駐模式設定 (--daemon)
+DAEMON_INTERVAL = 3600  # 未指定 --cron 時，兩次執行開始時間的間隔 (秒)
+
+# 執行統計設定
+METRICS_JSON_FILE = 'sync_metrics.json'  # 每次執行結束時輸出的 JSON 摘要
+METRICS_PROM_FILE = 'sync_metrics.prom'  # Prometheus textfile collector 格式
+METRICS_PROM_PREFIX = 'tii_sync'
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)  # 階段耗時直方圖區間 (秒)
 
 # --- 日誌設定 (Logging Configuration) ---
-log_file_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sync.log')
-# 修改日誌設定，使其同時輸出到檔案和控制台
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(log_file_path, encoding='utf-8'),
-        logging.StreamHandler() # 新增 StreamHandler 以輸出到控制台
-    ]
-)
+# 每個任務的處理細節 (刪除/新增/更新/跳過) 使用獨立的 logger，--log-verbosity summary 時關閉；
+# 以 % 參數延遲格式化，關閉時不必組字串
+task_log = logging.getLogger('tii_sync.task')
+_log_listener: Optional[QueueListener] = None
+
+def _gzip_namer(name: str) -> str:
+    return f"{name}.gz"
+
+def _gzip_rotator(source: str, dest: str):
+    """輪替時將舊日誌壓縮為 .gz"""
+    with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+def configure_logging(verbosity: str = 'full', rotation: str = LOG_ROTATION):
+    """
+    設定日誌同時輸出到檔案和控制台 (由 main 呼叫，import 本模組時不產生副作用)。
+    工作執行緒只把紀錄放入佇列，由背景的 QueueListener 執行緒寫入檔案與控制台；
+    日誌檔依大小或每日輪替，舊檔以 gzip 壓縮。
+    :param verbosity: full 記錄每個任務的處理細節；summary 只記錄摘要、警告與錯誤
+    :param rotation: size 依 LOG_MAX_BYTES 輪替；daily 每日午夜輪替
+    """
+    global _log_listener
+    stop_logging()
+    log_file_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), LOG_FILE)
+    if rotation == 'daily':
+        file_handler = TimedRotatingFileHandler(log_file_path, when='midnight', backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
+    else:
+        file_handler = RotatingFileHandler(log_file_path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
+    file_handler.namer = _gzip_namer
+    file_handler.rotator = _gzip_rotator
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    handlers = [file_handler, logging.StreamHandler()]  # 同時輸出到控制台
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(QueueHandler(log_queue))
+    root.setLevel(logging.INFO)
+    task_log.setLevel(logging.INFO if verbosity == 'full' else logging.WARNING)
+    _log_listener = QueueListener(log_queue, *handlers)
+    _log_listener.start()
+
+def stop_logging():
+    """寫出佇列中剩餘的日誌並關閉日誌檔"""
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        for handler in _log_listener.handlers:
+            handler.close()
+        _log_listener = None
+
+
+# --- 執行統計 (Run Metrics) ---
+class RunMetrics:
+    """
+    記錄單次執行的各階段耗時 (直方圖) 與事件計數，執行結束時輸出為 JSON 與 Prometheus textfile 格式。
+    所有方法皆為執行緒安全。
+    """
+
+    def __init__(self, buckets: Sequence[float] = METRICS_BUCKETS):
+        self._buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._started_at = time.time()
+        self._started = time.monotonic()
+        self._stages: Dict[str, Dict[str, Any]] = {}
+        self._counters: Counter = Counter()
+        self._gauges: Dict[str, float] = {}
+
+    def observe(self, stage: str, seconds: float):
+        """記錄一次階段耗時"""
+        with self._lock:
+            hist = self._stages.get(stage)
+            if hist is None:
+                hist = self._stages[stage] = {'count': 0, 'sum': 0.0, 'max': 0.0, 'buckets': [0] * len(self._buckets)}
+            hist['count'] += 1
+            hist['sum'] += seconds
+            hist['max'] = max(hist['max'], seconds)
+            for i, bound in enumerate(self._buckets):
+                if seconds <= bound:
+                    hist['buckets'][i] += 1
+                    break
+
+    @contextmanager
+    def timer(self, stage: str):
+        """計時區塊，結束 (包含拋出例外) 時記錄耗時"""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.monotonic() - started)
 
+    def inc(self, name: str, amount: int = 1):
+        """增加計數"""
+        with self._lock:
+            self._counters[name] += amount
 
+    def set_gauge(self, name: str, value: float):
+        """設定量測值 (例如各階段使用率)"""
+        with self._lock:
+            self._gauges[name] = value
 
-def save_cookie(cookie_str: str):
-    """將 Cookie 字串儲存到檔案"""
+    def _quantile(self, hist: Dict[str, Any], q: float) -> float:
+        """以直方圖估算分位數 (取所在區間的上界，不超過最大值)"""
+        rank = q * hist['count']
+        seen = 0
+        for bound, count in zip(self._buckets, hist['buckets']):
+            seen += count
+            if seen >= rank:
+                return min(bound, hist['max'])
+        return hist['max']
+
+    def snapshot(self) -> Dict[str, Any]:
+        """回傳目前的統計內容"""
+        with self._lock:
+            stages = {}
+            for stage, hist in sorted(self._stages.items()):
+                stages[stage] = {
+                    'count': hist['count'],
+                    'sum_seconds': round(hist['sum'], 4),
+                    'avg_seconds': round(hist['sum'] / hist['count'], 4),
+                    'p50_seconds': round(self._quantile(hist, 0.5), 4),
+                    'p95_seconds': round(self._quantile(hist, 0.95), 4),
+                    'max_seconds': round(hist['max'], 4)
+                }
+            return {
+                'started_at': datetime.fromtimestamp(self._started_at, LOCAL_TZ).isoformat(),
+                'duration_seconds': round(time.monotonic() - self._started, 3),
+                'counters': dict(sorted(self._counters.items())),
+                'gauges': dict(sorted(self._gauges.items())),
+                'stages': stages
+            }
+
+    def to_prometheus(self) -> str:
+        """輸出 Prometheus textfile collector 格式"""
+        prefix = METRICS_PROM_PREFIX
+        with self._lock:
+            lines = [
+                f'# HELP {prefix}_stage_seconds Time spent in each sync stage.',
+                f'# TYPE {prefix}_stage_seconds histogram'
+            ]
+            for stage, hist in sorted(self._stages.items()):
+                cumulative = 0
+                for bound, count in zip(self._buckets, hist['buckets']):
+                    cumulative += count
+                    lines.append(f'{prefix}_stage_seconds_bucket{{stage="{stage}",le="{bound:g}"}} {cumulative}')
+                lines.append(f'{prefix}_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {hist["count"]}')
+                lines.append(f'{prefix}_stage_seconds_sum{{stage="{stage}"}} {hist["sum"]:.6f}')
+                lines.append(f'{prefix}_stage_seconds_count{{stage="{stage}"}} {hist["count"]}')
+            # 計數器每次執行都從零開始，以 last_run_ 前綴的 gauge 輸出本次數值，避免被當成累積型 counter 計算 rate()；
+            # gauge 依慣例不帶 _total 後綴
+            for name, value in sorted(self._counters.items()):
+                metric = f'{prefix}_last_run_{name[:-len("_total")] if name.endswith("_total") else name}'
+                lines.append(f'# TYPE {metric} gauge')
+                lines.append(f'{metric} {value}')
+            for name, value in sorted(self._gauges.items()):
+                lines.append(f'# TYPE {prefix}_{name} gauge')
+                lines.append(f'{prefix}_{name} {value}')
+            lines += [
+                f'# TYPE {prefix}_last_run_timestamp_seconds gauge',
+                f'{prefix}_last_run_timestamp_seconds {self._started_at:.0f}',
+                f'# TYPE {prefix}_last_run_duration_seconds gauge',
+                f'{prefix}_last_run_duration_seconds {time.monotonic() - self._started:.3f}'
+            ]
+        return '\n'.join(lines) + '\n'
+
+    def write(self, json_path: Optional[str] = METRICS_JSON_FILE, prom_path: Optional[str] = METRICS_PROM_FILE):
+        """
+        以先寫暫存檔再取代的方式輸出統計檔，讓 node_exporter 等讀取端不會讀到寫到一半的檔案
+        :param json_path: JSON 摘要路徑，None 或空字串表示不輸出
+        :param prom_path: Prometheus textfile 路徑，None 或空字串表示不輸出
+        """
+        outputs = []
+        if json_path:
+            outputs.append((json_path, json.dumps(self.snapshot(), ensure_ascii=False, indent=2)))
+        if prom_path:
+            outputs.append((prom_path, self.to_prometheus()))
+        for path, content in outputs:
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+
+_metrics = RunMetrics()
+
+def get_metrics() -> RunMetrics:
+    """取得本次執行的統計物件"""
+    return _metrics
+
+def reset_metrics() -> RunMetrics:
+    """開始新的一次執行時重設統計"""
+    global _metrics
+    _metrics = RunMetrics()
+    return _metrics
+
+# --- HTTP 連線池 (HTTP Session Pool) ---
+_http_session: Optional[requests.Session] = None
+_http_session_lock = threading.Lock()
+
+def _build_http_session(pool_maxsize: int = HTTP_POOL_MAXSIZE) -> requests.Session:
+    """
+    建立具備 keep-alive 連線池與重試機制的 Session。
+    :param pool_maxsize: 每個主機的最大連線數
+    :return: requests.Session
+    """
+    retry = Retry(
+        total=HTTP_MAX_RETRIES,
+        read=False,  # 讀取逾時直接拋出 Timeout，由 RetryPolicy 分類並經速率控制器重試
+        status=0,
+        backoff_factor=HTTP_BACKOFF_FACTOR,
+        allowed_methods=frozenset({'GET', 'POST'})  # 此 API 為查詢用途，POST 重試是安全的
+    )
+    adapter = HTTPAdapter(
+        pool_connections=HTTP_POOL_CONNECTIONS,
+        pool_maxsize=pool_maxsize,
+        max_retries=retry,
+        pool_block=True  # 連線用盡時等待，而不是額外開新連線
+    )
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({'User-Agent': USER_AGENT, 'Connection': 'keep-alive'})
+    return session
+
+def get_http_session() -> requests.Session:
+    """取得全域共用的 HTTP Session (執行緒安全，延遲建立)"""
+    global _http_session
+    if _http_session is None:
+        with _http_session_lock:
+            if _http_session is None:
+                _http_session = _build_http_session()
+    return _http_session
+
+def close_http_session():
+    """關閉全域 HTTP Session 並釋放所有連線"""
+    global _http_session
+    with _http_session_lock:
+        if _http_session is not None:
+            _http_session.close()
+            _http_session = None
+
+# --- 自適應速率控制 (Adaptive Rate Limiter) ---
+class AdaptiveRateLimiter:
+    """
+    所有工作執行緒共用的 token bucket 速率控制器。
+    回應快速時以加法提高速率，遇到逾時、HTTP 429/5xx 或回應過慢時以乘法退避 (AIMD)。
+    """
+
+    def __init__(self, initial_rate: float = RATE_INITIAL, min_rate: float = RATE_MIN,
+                 max_rate: float = RATE_MAX, burst: float = RATE_BURST):
+        self._min_rate = min_rate
+        self._max_rate = max_rate
+        self._burst = burst
+        self._rate = min(max(initial_rate, min_rate), max_rate)
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+        self._started = None
+        self._requests = 0
+        self._waited = 0.0
+        self._increases = 0
+        self._decreases = 0
+        self._peak_rate = self._rate
+
+    def _try_acquire(self) -> float:
+        """
+        嘗試取得一個 token
+        :return: 0 表示已取得；否則為依目前速率建議等待的秒數
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self._started is None:
+                self._started = now
+            self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                self._requests += 1
+                return 0.0
+            return (1 - self._tokens) / self._rate
+
+    def _add_wait(self, seconds: float):
+        with self._lock:
+            self._waited += seconds
+
+    def acquire(self):
+        """阻塞直到可以送出下一個請求；等待期間速率若被調整，醒來時會依新速率重新計算"""
+        started = time.monotonic()
+        while True:
+            wait = self._try_acquire()
+            if wait <= 0:
+                break
+            time.sleep(wait * random.uniform(1, 1.2))  # 加入抖動，避免等待者同時醒來
+        self._add_wait(time.monotonic() - started)
+
+    async def acquire_async(self):
+        """acquire 的非同步版本"""
+        started = time.monotonic()
+        while True:
+            wait = self._try_acquire()
+            if wait <= 0:
+                break
+            await asyncio.sleep(wait * random.uniform(1, 1.2))
+        self._add_wait(time.monotonic() - started)
+
+    def record(self, latency: float, status: Optional[int] = None, failed: bool = False):
+        """
+        回報請求結果並調整速率
+        :param latency: 請求耗時 (秒)
+        :param status: HTTP 狀態碼，逾時或連線失敗時為 None
+        :param failed: 請求是否失敗
+        """
+        overloaded = (
+            status == 429
+            or (status is not None and status >= 500)
+            or (failed and status is None)
+            or latency > RATE_SLOW_RESPONSE
+        )
+        with self._lock:
+            now = time.monotonic()
+            if overloaded:
+                if now - self._last_decrease >= RATE_DECREASE_COOLDOWN:
+                    self._rate = max(self._min_rate, self._rate * RATE_DECREASE_FACTOR)
+                    self._last_decrease = now
+                    self._decreases += 1
+            elif not failed and self._rate < self._max_rate:
+                self._rate = min(self._max_rate, self._rate + RATE_INCREASE_STEP)
+                self._increases += 1
+                self._peak_rate = max(self._peak_rate, self._rate)
+
+    def stats(self) -> Dict[str, float]:
+        """回傳速率控制統計資料，achieved_rate 為實際達成的每秒請求數"""
+        with self._lock:
+            elapsed = time.monotonic() - self._started if self._started is not None else 0.0
+            return {
+                'requests': self._requests,
+                'achieved_rate': round(self._requests / elapsed, 2) if elapsed > 0 else 0.0,
+                'current_rate': round(self._rate, 2),
+                'peak_rate': round(self._peak_rate, 2),
+                'increases': self._increases,
+                'decreases': self._decreases,
+                'total_wait_seconds': round(self._waited, 2)
+            }
+
+_rate_limiter: Optional[AdaptiveRateLimiter] = None
+_rate_limiter_lock = threading.Lock()
+
+def get_rate_limiter() -> AdaptiveRateLimiter:
+    """取得全域共用的速率控制器 (延遲建立)"""
+    global _rate_limiter
+    if _rate_limiter is None:
+        with _rate_limiter_lock:
+            if _rate_limiter is None:
+                _rate_limiter = AdaptiveRateLimiter()
+    return _rate_limiter
+
+def configure_rate_limiter(initial_rate: float = RATE_INITIAL, max_rate: float = RATE_MAX) -> AdaptiveRateLimiter:
+    """以指定的初始速率與上限重新建立全域速率控制器"""
+    global _rate_limiter
+    with _rate_limiter_lock:
+        _rate_limiter = AdaptiveRateLimiter(initial_rate=initial_rate, max_rate=max_rate)
+    return _rate_limiter
+
+# --- Session 儲存 (Session Store) ---
+_session_file_lock = threading.Lock()
+
+def _write_session(session: Dict):
+    """以先寫暫存檔再取代的方式儲存 session，避免中途中斷留下損壞的檔案"""
+    tmp_path = f"{SESSION_FILE}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(session, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, SESSION_FILE)
+
+def save_session(cookies: List[Dict], verified: bool = True):
+    """
+    儲存登入後取得的 Cookie 與取得時間
+    :param cookies: Cookie 清單，每個元素包含 name、value，以及可選的 domain、path、expires (Unix 秒，-1 或 None 表示 session cookie)
+    :param verified: Cookie 是否剛確認有效；否則下次使用前會先探測
+    """
+    now = time.time()
+    session = {
+        'cookies': [
+            {
+                'name': c['name'],
+                'value': c['value'],
+                'domain': c.get('domain'),
+                'path': c.get('path'),
+                'expires': c.get('expires') if c.get('expires') not in (None, -1) else None
+            }
+            for c in cookies
+        ],
+        'acquired_at': now,
+        'last_verified_at': now if verified else 0
+    }
     try:
-        with open(COOKIE_FILE, 'w', encoding='utf-8') as f:
-            f.write(cookie_str)
+        with _session_file_lock:
+            _write_session(session)
         logging.info("Cookie 已成功儲存。")
-    except IOError as e:
+    except (IOError, TypeError) as e:
         logging.error(f"儲存 Cookie 失敗: {e}")
 
+def save_cookie(cookie_str: str, verified: bool = True):
+    """將 Cookie 字串 ("name=value; ...") 儲存到 session 檔案"""
+    cookies = []
+    for part in cookie_str.split(';'):
+        name, sep, value = part.strip().partition('=')
+        if sep:
+            cookies.append({'name': name, 'value': value})
+    save_session(cookies, verified)
+
+def load_session() -> Optional[Dict]:
+    """讀取 session 檔案；若只有舊版純文字 Cookie 檔案則自動轉換"""
+    with _session_file_lock:
+        if os.path.exists(SESSION_FILE):
+            try:
+                with open(SESSION_FILE, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+            except (IOError, ValueError) as e:
+                logging.error(f"讀取 Cookie 失敗: {e}")
+                return None
+        if not os.path.exists(COOKIE_FILE):
+            return None
+        try:
+            with open(COOKIE_FILE, 'r', encoding='utf-8') as f:
+                cookie_str = f.read().strip()
+        except IOError as e:
+            logging.error(f"讀取 Cookie 失敗: {e}")
+            return None
+    if not cookie_str:
+        return None
+    logging.info("偵測到舊版 Cookie 檔案，轉換為 session 檔案。")
+    save_cookie(cookie_str, verified=False)  # 舊檔案的 Cookie 未經驗證，使用前需先探測
+    with _session_file_lock:
+        if os.path.exists(COOKIE_FILE):
+            os.remove(COOKIE_FILE)
+    return load_session()
+
 def get_cookie() -> Optional[str]:
-    """從檔案讀取 Cookie"""
-    if not os.path.exists(COOKIE_FILE):
+    """從 session 檔案讀取尚未過期的 Cookie，組成請求標頭用的字串"""
+    session = load_session()
+    if not session:
         return None
-    try:
-        with open(COOKIE_FILE, 'r', encoding='utf-8') as f:
-            return f.read().strip()
-    except IOError as e:
-        logging.error(f"讀取 Cookie 失敗: {e}")
+    now = time.time()
+    valid = [c for c in session.get('cookies', []) if c.get('expires') is None or c['expires'] > now]
+    if len(valid) < len(session.get('cookies', [])):
+        logging.info(f"有 {len(session['cookies']) - len(valid)} 個 Cookie 已過期。")
+    if not valid:
         return None
+    return '; '.join(f"{c['name']}={c['value']}" for c in valid)
 
-def clear_cookies():
-    """清除本地儲存的 Cookie 檔案"""
-    if os.path.exists(COOKIE_FILE):
+def mark_session_verified():
+    """記錄 session 最近一次確認有效的時間"""
+    with _session_file_lock:
         try:
-            os.remove(COOKIE_FILE)
-            logging.info("Cookie 檔案已清除。")
-        except OSError as e:
-            logging.error(f"清除 Cookie 檔案時發生錯誤: {e}")
+            with open(SESSION_FILE, 'r', encoding='utf-8') as f:
+                session = json.load(f)
+            session['last_verified_at'] = time.time()
+            _write_session(session)
+        except (IOError, ValueError) as e:
+            logging.warning(f"更新 session 驗證時間失敗: {e}")
+
+def clear_cookies():
+    """清除本地儲存的 session 與舊版 Cookie 檔案"""
+    with _session_file_lock:
+        for path in (SESSION_FILE, COOKIE_FILE):
+            if os.path.exists(path):
+                try:
+                    os.remove(path)
+                    logging.info("Cookie 檔案已清除。")
+                except OSError as e:
+                    logging.error(f"清除 Cookie 檔案時發生錯誤: {e}")
+
+def probe_session(cookie_str: str) -> Optional[bool]:
+    """
+    以一次極小的 API 查詢確認 Cookie 是否仍有效
+    :param cookie_str: 用於驗證的 Cookie
+    :return: True 有效，False 已失效，None 無法判斷 (網路錯誤)
+    """
+    try:
+        response = get_http_session().post(
+            API_URL,
+            headers=_api_headers(cookie_str),
+            data={'salesregid': '', 'finish_start_date': 0, 'finish_end_date': 0},
+            timeout=REQUEST_TIMEOUT,
+            allow_redirects=False
+        )
+        api_data = _parse_api_response(response)
+    except SessionExpiredError:
+        return False
+    except requests.exceptions.RequestException as e:
+        logging.warning(f"Session 驗證請求失敗，無法判斷 Cookie 是否有效: {e}")
+        return None
+    return isinstance(api_data, dict) and 'total' in api_data
+
+def ensure_session() -> Optional[str]:
+    """
+    在派發任務前確認 session 可用：最近驗證過的直接沿用，否則先探測，失效時重新登入
+    :return: 可用的 Cookie 字串，登入失敗時為 None
+    """
+    cookie_str = get_cookie()
+    if cookie_str:
+        session = load_session() or {}
+        age = time.time() - session.get('last_verified_at', 0)
+        if age < SESSION_VERIFY_TTL:
+            logging.info(f"沿用 {int(age)} 秒前驗證過的 Cookie。")
+            return cookie_str
+        valid = probe_session(cookie_str)
+        if valid is not False:
+            if valid:
+                mark_session_verified()
+                logging.info("Cookie 驗證有效，沿用現有 session。")
+            return cookie_str
+        logging.info("Cookie 已失效，重新登入。")
+        clear_cookies()
+    else:
+        logging.info("本地無有效 Cookie，執行登入程序。")
+
+    if not login_and_save_cookie():
+        logging.error("登入失敗，程序終止。")
+        return None
+    cookie_str = get_cookie()
+    if not cookie_str:
+        logging.error("即使登入後也無法獲取 Cookie，程序終止。")
+    return cookie_str
+
+class SessionExpiredError(Exception):
+    """API 回應顯示登入狀態已失效"""
+
+class SessionManager:
+    """
+    工作執行緒共用的登入狀態。
+    偵測到 session 失效時只由第一個回報的執行緒重新登入 (single-flight)，
+    登入期間其他執行緒暫停取得 Cookie，登入完成後再以新的 Cookie 重試任務。
+    """
+
+    def __init__(self, cookie_str: str):
+        self._cookie_str = cookie_str
+        self._generation = 0
+        self._failed = False
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._ready.set()
+        self.refreshes = 0
+
+    def current(self) -> Tuple[str, int]:
+        """
+        取得目前的 Cookie，重新登入期間會等待
+        :return: (Cookie, 版本號)；版本號用於 refresh 判斷是否已被其他執行緒更新
+        """
+        self._ready.wait()
+        return self._cookie_str, self._generation
+
+    async def current_async(self) -> Tuple[str, int]:
+        """current 的非同步版本，等待期間不阻塞事件迴圈"""
+        while not self._ready.is_set():
+            await asyncio.sleep(0.5)
+        return self._cookie_str, self._generation
+
+    def refresh(self, generation: int) -> bool:
+        """
+        回報 session 失效，先探測目前的 Cookie，確定失效才重新登入
+        :param generation: 失敗請求所使用的 Cookie 版本號
+        :return: 是否已有可用的新 Cookie
+        """
+        with self._lock:
+            if self._generation != generation or self._failed:
+                return not self._failed  # 已由其他執行緒處理
+            self._ready.clear()
+            try:
+                logging.warning("偵測到 session 失效，暫停派發並確認登入狀態。")
+                valid = probe_session(self._cookie_str)
+                if valid is not False:
+                    # 單次回應誤判為失效 (例如伺服器暫時轉址) 或無法判斷時沿用 Cookie，與 ensure_session 一致；
+                    # 版本號仍遞增，讓同一批回報失效的執行緒直接以原 Cookie 重試 (重試次數受 SESSION_REPLAY_LIMIT 限制)
+                    if valid:
+                        mark_session_verified()
+                    self._generation += 1
+                    logging.info("Cookie 未確定失效，略過重新登入並繼續處理任務。")
+                    return True
+                logging.warning("Cookie 已失效，重新登入。")
+                clear_cookies()
+                cookie_str = get_cookie() if login_and_save_cookie() else None
+                if cookie_str:
+                    self._cookie_str = cookie_str
+                    self._generation += 1
+                    self.refreshes += 1
+                    logging.info("重新登入成功，繼續處理任務。")
+                else:
+                    self._failed = True
+                    logging.error("重新登入失敗，剩餘任務將不再重試。")
+            finally:
+                self._ready.set()
+            return not self._failed
+
+# --- 登入用戶端 (Login Client) ---
+_ocr = None
+_ocr_lock = threading.Lock()
+
+def get_ocr():
+    """取得全域共用的 ddddocr 模型 (第一次使用時載入，之後常駐)"""
+    global _ocr
+    if _ocr is None:
+        with _ocr_lock:
+            if _ocr is None:
+                import ddddocr  # 載入 onnxruntime 與模型較慢，只在需要辨識驗證碼時載入
+                _ocr = ddddocr.DdddOcr()
+    return _ocr
+
+def _captcha_variants(img_bytes: bytes) -> List[Tuple[str, bytes]]:
+    """產生驗證碼圖片的多種前處理版本 (原圖、灰階、二值化、去雜訊、放大)"""
+    from PIL import Image, ImageFilter, ImageOps
+
+    def encode(image) -> bytes:
+        buffer = io.BytesIO()
+        image.save(buffer, format='PNG')
+        return buffer.getvalue()
+
+    image = Image.open(io.BytesIO(img_bytes)).convert('RGB')
+    gray = ImageOps.autocontrast(image.convert('L'))
+    histogram = gray.histogram()
+    threshold = sum(level * count for level, count in enumerate(histogram)) / max(1, sum(histogram))
+    binarize = lambda level: 255 if level > threshold else 0
+    return [
+        ('original', img_bytes),
+        ('gray', encode(gray)),
+        ('binary', encode(gray.point(binarize))),
+        ('denoise', encode(gray.filter(ImageFilter.MedianFilter(3)).point(binarize))),
+        ('scaled', encode(image.resize((image.width * 2, image.height * 2), Image.LANCZOS)))
+    ]
+
+def _classify_with_confidence(ocr, img_bytes: bytes) -> Tuple[str, float]:
+    """
+    以 ddddocr 辨識並取得信心分數 (各字元最大機率的平均)
+    同時支援 ddddocr 1.6 以後的 {'text', 'confidence'} 與較舊版本的 {'charsets', 'probability'} 格式
+    """
+    result = ocr.classification(img_bytes, probability=True)
+    if 'text' in result:
+        return result['text'], float(result.get('confidence', 0.0))
+
+    import numpy as np
+    charsets = result['charsets']
+    steps = np.asarray(result['probability'])
+    if steps.ndim == 1:
+        steps = steps[np.newaxis, :]
+    best = steps.argmax(axis=1)
+    chars, probs, previous = [], [], None
+    for step, index in enumerate(best):
+        # CTC 解碼：合併連續重複並去除空白 (索引 0)
+        if index != previous and charsets[index] != '':
+            chars.append(charsets[index])
+            probs.append(float(steps[step, index]))
+        previous = index
+    return ''.join(chars), (sum(probs) / len(probs) if probs else 0.0)
+
+def rank_captcha_candidates(img_bytes: bytes, ocr=None) -> List[Tuple[str, float]]:
+    """
+    將多種前處理版本平行送入 OCR，依信心分數與長度/字元限制排序候選答案
+    原圖的辨識結果已符合限制且信心足夠時直接採用，不再處理其他版本
+    相同答案的分數會累加，多個版本都認同的答案排在前面
+    :return: [(候選答案, 分數)]，分數由高到低
+    """
+    ocr = ocr or get_ocr()
+
+    def is_valid(text: str) -> bool:
+        if CAPTCHA_LENGTH is not None and len(text) != CAPTCHA_LENGTH:
+            return False
+        return re.fullmatch(CAPTCHA_CHARSET, text) is not None
+
+    text, confidence = _classify_with_confidence(ocr, img_bytes)
+    text = text.strip()
+    if text and is_valid(text) and confidence >= CAPTCHA_ACCEPT_CONFIDENCE:
+        return [(text, confidence)]
+
+    variants = _captcha_variants(img_bytes)[1:]
+    with ThreadPoolExecutor(max_workers=len(variants), thread_name_prefix='captcha') as executor:
+        results = list(executor.map(lambda variant: _classify_with_confidence(ocr, variant[1]), variants))
+
+    scores: Dict[str, float] = {}
+    for (name, _), (text, confidence) in zip([('original', img_bytes)] + variants, [(text, confidence)] + results):
+        text = text.strip()
+        if not text:
+            continue
+        valid = is_valid(text)
+        scores[text] = scores.get(text, 0.0) + confidence * (1.0 if valid else CAPTCHA_INVALID_PENALTY)
+        logging.debug(f"驗證碼候選 ({name}): {text} 信心 {confidence:.3f}{'' if valid else ' (不符限制)'}")
+    return sorted(scores.items(), key=lambda candidate: candidate[1], reverse=True)
+
+def solve_captcha(img_bytes: bytes, ocr=None) -> str:
+    """回傳排名最高的驗證碼答案；沒有任何候選時退回單次辨識"""
+    candidates = rank_captcha_candidates(img_bytes, ocr)
+    if candidates:
+        return candidates[0][0]
+    return (ocr or get_ocr()).classification(img_bytes)
+
+def _refresh_captcha(page) -> bool:
+    """
+    只重新載入驗證碼圖片，不重新載入整個登入頁
+    :return: 是否成功更新 (找不到驗證碼元素時回傳 False)
+    """
+    return page.evaluate(
+        """selector => new Promise(resolve => {
+            const img = document.querySelector(selector);
+            if (!img) { resolve(false); return; }
+            img.onload = () => resolve(true);
+            img.onerror = () => resolve(false);
+            img.src = img.src.split('?')[0] + '?' + Date.now();
+        })""",
+        CAPTCHA_IMG_SELECTOR
+    )
 
 def _attempt_login(page, ocr, username, password) -> bool:
     """
-    執行單次登入嘗試。
+    在已開啟的登入頁上執行單次登入嘗試。
     :return: 是否成功
     """
     try:
-        page.goto(LOGIN_URL, timeout=60000)
-
         page.fill(USERNAME_SELECTOR, username)
         page.fill(PASSWORD_SELECTOR, password)
 
@@ -94,230 +875,2479 @@ def _attempt_login(page, ocr, username, password) -> bool:
         if not captcha_element:
             logging.error("找不到驗證碼圖片元素。")
             return False
-        
+
         img_bytes = captcha_element.screenshot()
-        captcha_text = ocr.classification(img_bytes)
+        captcha_text = solve_captcha(img_bytes, ocr)
         logging.info(f"OCR 辨識結果: {captcha_text}")
 
         page.fill(CAPTCHA_CODE_SELECTOR, captcha_text)
 
-        # 點擊登入並等待頁面導航
-        page.click(SIGNIN_BUTTON_SELECTOR)
+        # 點擊登入後輪詢結果：URL 離開登入頁即成功，出現錯誤訊息即失敗，不必等待 networkidle
+        page.click(SIGNIN_BUTTON_SELECTOR, no_wait_after=True)
+        deadline = time.monotonic() + LOGIN_RESULT_TIMEOUT
+        while time.monotonic() < deadline:
+            if "mpage" not in page.url:
+                logging.info("登入成功！URL 已變更。")
+                save_session(page.context.cookies())
+                return True
+            error_element = page.query_selector(ERROR_ALERT_SELECTOR)
+            if error_element and error_element.is_visible():
+                logging.warning(f"登入失敗: {error_element.inner_text()}")
+                return False
+            page.wait_for_timeout(100)
 
-        # 使用更可靠的方式判斷登入結果
-        # 1. 等待 URL 變化 (成功)
-        # 2. 或者等待錯誤訊息出現 (失敗)
-        page.wait_for_load_state('networkidle', timeout=5000)
-
-        if "mpage" not in page.url:
-            logging.info("登入成功！URL 已變更。")
-            cookies = page.context.cookies()
-            cookie_str = '; '.join([f"{c['name']}={c['value']}" for c in cookies])
-            save_cookie(cookie_str)
-            return True
-        
-        # 檢查是否有錯誤提示
-        error_element = page.query_selector(ERROR_ALERT_SELECTOR)
-        if error_element:
-            logging.warning(f"登入失敗: {error_element.inner_text()}")
+        logging.warning("等待登入結果超時，可能登入失敗或網路延遲。")
         return False
-    except PlaywrightTimeoutError:
+    except Exception as e:
+        from playwright.sync_api import TimeoutError as PlaywrightTimeoutError
+        if not isinstance(e, PlaywrightTimeoutError):
+            raise
         logging.warning("等待頁面載入超時，可能登入失敗或網路延遲。")
         return False
 
+class BrowserLoginClient:
+    """
+    常駐的 Playwright 登入用戶端。
+    瀏覽器、context 與登入頁在第一次登入時建立並保留到程序結束，重試時只更新驗證碼。
+    Playwright 同步 API 只能在建立它的執行緒使用，因此所有瀏覽器操作都在專屬的登入執行緒中執行。
+    """
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='login')
+        self._playwright = None
+        self._browser = None
+        self._context = None
+        self._page = None
+
+    def login(self, username: str, password: str, max_attempts: int) -> bool:
+        """在登入執行緒中執行登入，阻塞直到完成"""
+        return self._executor.submit(self._login, username, password, max_attempts).result()
+
+    def close(self):
+        """關閉瀏覽器並結束登入執行緒"""
+        self._executor.submit(self._shutdown).result()
+        self._executor.shutdown(wait=True)
+
+    def _ensure_page(self):
+        if self._page is not None and not self._page.is_closed():
+            return self._page
+        if self._browser is None or not self._browser.is_connected():
+            if self._playwright is None:
+                from playwright.sync_api import sync_playwright
+                self._playwright = sync_playwright().start()
+            self._browser = self._playwright.chromium.launch(headless=True)
+            self._context = None
+        if self._context is None:
+            self._context = self._browser.new_context()
+        self._page = self._context.new_page()
+        return self._page
+
+    def _reset_page(self):
+        if self._page is not None:
+            try:
+                self._page.close()
+            except Exception:
+                pass
+        self._page = None
+
+    def _login(self, username: str, password: str, max_attempts: int) -> bool:
+        ocr = get_ocr()
+        page_ready = False
+        for attempt in range(max_attempts):
+            logging.info(f"正在嘗試登入，第 {attempt + 1}/{max_attempts} 次...")
+            try:
+                page = self._ensure_page()
+                if not page_ready:
+                    self._context.clear_cookies()  # 重新登入時不沿用已失效的 Cookie
+                    page.goto(LOGIN_URL, timeout=60000, wait_until='domcontentloaded')
+                    page_ready = True
+                elif not _refresh_captcha(page):
+                    page.goto(LOGIN_URL, timeout=60000, wait_until='domcontentloaded')
+                if _attempt_login(page, ocr, username, password):
+                    return True
+            except Exception as e:
+                logging.error(f"登入過程中發生未知錯誤: {e}")
+                self._reset_page()
+                page_ready = False
+            time.sleep(random.uniform(*LOGIN_RETRY_DELAY))  # 每次失敗後稍作等待
+        return False
+
+    def _shutdown(self):
+        self._reset_page()
+        for resource in (self._context, self._browser):
+            if resource is not None:
+                try:
+                    resource.close()
+                except Exception:
+                    pass
+        if self._playwright is not None:
+            self._playwright.stop()
+        self._playwright = self._browser = self._context = None
+
+_login_client: Optional[BrowserLoginClient] = None
+_login_backend = LOGIN_BACKEND
+_login_client_lock = threading.Lock()
+
+def get_login_client() -> BrowserLoginClient:
+    """取得全域共用的登入用戶端 (延遲建立，保留到 close_login_client 為止)"""
+    global _login_client
+    if _login_client is None:
+        with _login_client_lock:
+            if _login_client is None:
+                _login_client = BrowserLoginClient()
+    return _login_client
+
+def close_login_client():
+    """關閉全域登入用戶端"""
+    global _login_client
+    with _login_client_lock:
+        if _login_client is not None:
+            _login_client.close()
+            _login_client = None
+
+class _LoginPageParser(HTMLParser):
+    """收集登入頁中的表單欄位與圖片"""
+
+    def __init__(self):
+        super().__init__()
+        self.forms: List[Dict] = []
+        self.images: List[Dict] = []
+        self._form = None
+
+    def handle_starttag(self, tag, attrs):
+        attrs = {name: value or '' for name, value in attrs}
+        if tag == 'form':
+            self._form = {'action': attrs.get('action', ''), 'method': attrs.get('method', 'get').lower(), 'fields': []}
+            self.forms.append(self._form)
+        elif tag in ('input', 'button') and self._form is not None:
+            self._form['fields'].append(dict(attrs, tag=tag))
+        elif tag == 'img':
+            self.images.append(attrs)
+
+    def handle_endtag(self, tag):
+        if tag == 'form':
+            self._form = None
+
+def _parse_login_page(html: str, page_url: str) -> Optional[Dict]:
+    """
+    從登入頁 HTML 找出登入表單 (以 USERNAME_SELECTOR 等選擇器的 id 對應欄位)
+    :return: {'action', 'method', 'data', 'username', 'password', 'captcha', 'captcha_url'}；找不到表單時為 None
+    """
+    parser = _LoginPageParser()
+    parser.feed(html)
+    ids = {
+        'username': USERNAME_SELECTOR.lstrip('#'),
+        'password': PASSWORD_SELECTOR.lstrip('#'),
+        'captcha': CAPTCHA_CODE_SELECTOR.lstrip('#')
+    }
+    submit_class = SIGNIN_BUTTON_SELECTOR.lstrip('.')
+    captcha_img = next((img for img in parser.images if img.get('id') == CAPTCHA_IMG_SELECTOR.lstrip('#')), None)
+    for form in parser.forms:
+        by_id = {field.get('id'): field for field in form['fields'] if field.get('id')}
+        if not all(field_id in by_id and by_id[field_id].get('name') for field_id in ids.values()) or not captcha_img:
+            continue
+        data = {
+            field['name']: field.get('value', '')
+            for field in form['fields']
+            if field.get('name') and field.get('type', '').lower() == 'hidden'
+        }
+        for field in form['fields']:
+            if submit_class in field.get('class', '').split() and field.get('name'):
+                data[field['name']] = field.get('value', '')
+        return {
+            'action': urljoin(page_url, form['action'] or page_url),
+            'method': form['method'],
+            'data': data,
+            'username': by_id[ids['username']]['name'],
+            'password': by_id[ids['password']]['name'],
+            'captcha': by_id[ids['captcha']]['name'],
+            'captcha_url': urljoin(page_url, captcha_img.get('src', ''))
+        }
+    return None
+
+class HttpLoginClient:
+    """
+    不需瀏覽器的登入用戶端：以 HTTP 取得登入頁與驗證碼圖片，直接送出登入表單並取得 Cookie。
+    適用於沒有安裝瀏覽器的容器，登入頁結構無法辨識時回傳失敗，由呼叫端改用 Playwright。
+    """
+
+    def login(self, username: str, password: str, max_attempts: int) -> bool:
+        ocr = get_ocr()
+        with requests.Session() as http:
+            http.headers.update({'User-Agent': USER_AGENT})
+            form = None
+            for attempt in range(max_attempts):
+                logging.info(f"正在以 HTTP 嘗試登入，第 {attempt + 1}/{max_attempts} 次...")
+                try:
+                    if form is None:
+                        page = http.get(LOGIN_URL, timeout=REQUEST_TIMEOUT)
+                        page.raise_for_status()
+                        form = _parse_login_page(page.text, page.url)
+                        if form is None:
+                            logging.warning("無法從登入頁找到登入表單，HTTP 登入不可用。")
+                            return False
+
+                    captcha = http.get(form['captcha_url'], timeout=REQUEST_TIMEOUT)
+                    captcha.raise_for_status()
+                    captcha_text = solve_captcha(captcha.content, ocr)
+                    logging.info(f"OCR 辨識結果: {captcha_text}")
+
+                    data = dict(form['data'])
+                    data[form['username']] = username
+                    data[form['password']] = password
+                    data[form['captcha']] = captcha_text
+                    if form['method'] == 'post':
+                        response = http.post(form['action'], data=data, timeout=REQUEST_TIMEOUT)
+                    else:
+                        response = http.get(form['action'], params=data, timeout=REQUEST_TIMEOUT)
+                    response.raise_for_status()
+
+                    if "mpage" not in response.url:
+                        # 表單送出後離開登入頁不代表登入成功 (可能是錯誤頁)，以 API 確認 session 有效後才儲存
+                        cookie_str = '; '.join(f"{c.name}={c.value}" for c in http.cookies)
+                        if probe_session(cookie_str):
+                            logging.info("HTTP 登入成功！已確認 session 有效。")
+                            save_session([
+                                {'name': c.name, 'value': c.value, 'domain': c.domain, 'path': c.path, 'expires': c.expires}
+                                for c in http.cookies
+                            ])
+                            return True
+                        logging.warning(f"HTTP 登入後無法確認 session 有效 (URL: {response.url})。")
+                        form = None
+                    else:
+                        logging.warning("HTTP 登入失敗，仍停留在登入頁。")
+                        # 回應若仍是登入頁，沿用其中的表單 (隱藏欄位可能已更新)，否則下次重新取得
+                        form = _parse_login_page(response.text, response.url)
+                except requests.exceptions.RequestException as e:
+                    logging.error(f"HTTP 登入請求失敗: {e}")
+                    form = None
+                except Exception as e:
+                    # 例如驗證碼網址回傳的不是圖片 (錯誤頁或以 JavaScript 產生的驗證碼)，OCR 無法解析
+                    logging.error(f"HTTP 登入嘗試異常: {type(e).__name__}: {e}")
+                    form = None
+                time.sleep(random.uniform(*LOGIN_RETRY_DELAY))
+        return False
+
 # --- 登入主函式 (Main Login Function) ---
 def login_and_save_cookie(max_attempts: int = 10) -> bool:
     """
-    使用 Playwright 和 ddddocr 登入 TII eLearning 平台並儲存 Cookie。
-    :param max_attempts: 最大嘗試次數
+    使用 ddddocr 登入 TII eLearning 平台並儲存 Cookie。
+    依 _login_backend 使用 HTTP 表單登入、Playwright，或先 HTTP 失敗後改用 Playwright (auto)。
+    瀏覽器與 OCR 模型在多次登入之間常駐，並記錄取得已登入 session 所花的時間。
+    :param max_attempts: 每種登入方式的最大嘗試次數
     :return: 是否登入成功
     """
     username = os.environ.get('TII_USERNAME')
     password = os.environ.get('TII_PASSWORD')
-    ocr = ddddocr.DdddOcr()
+    backends = {
+        'http': ('http',),
+        'browser': ('browser',),
+        'auto': ('http', 'browser')
+    }[_login_backend]
 
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=True)
+    metrics = get_metrics()
+    started = time.monotonic()
+    for backend in backends:
+        client = HttpLoginClient() if backend == 'http' else get_login_client()
         try:
-            for attempt in range(max_attempts):
-                logging.info(f"正在嘗試登入，第 {attempt + 1}/{max_attempts} 次...")
-                page = browser.new_page()
-                if _attempt_login(page, ocr, username, password):
-                    return True
-                page.close() # 關閉當前頁面，下次迴圈開新的
-                time.sleep(random.uniform(2, 4)) # 每次失敗後稍作等待
+            logged_in = client.login(username, password, max_attempts)
         except Exception as e:
-            logging.error(f"登入過程中發生未知錯誤: {e}")
-        finally:
-            browser.close()
+            logging.error(f"{backend} 登入發生異常: {type(e).__name__}: {e}")
+            logged_in = False
+        if logged_in:
+            metrics.observe('login', time.monotonic() - started)
+            metrics.inc('logins')
+            logging.info(f"取得已登入 session 耗時 {time.monotonic() - started:.1f} 秒 (登入方式: {backend})。")
+            return True
+        if backend != backends[-1]:
+            logging.warning(f"{backend} 登入失敗，改用下一種登入方式。")
 
-    logging.error("所有登入嘗試均失敗。")
+    metrics.observe('login', time.monotonic() - started)
+    metrics.inc('login_failures')
+    logging.error(f"所有登入嘗試均失敗 (耗時 {time.monotonic() - started:.1f} 秒)。")
     return False
 
-# --- 核心同步邏輯 (Core Synchronization Logic) ---
-def sync_data(item: Dict, cookie_str: str) -> bool:
+# --- 本機同步狀態 (Local Sync State) ---
+class StateStore:
     """
-    同步單條資料到資料庫
-    :param item: 包含銷售登記ID和日期範圍的資料字典
-    :param cookie_str: 用於驗證的 Cookie
-    :return: 是否同步成功
+    本機 SQLite 狀態檔，保存跨次執行的同步狀態。
+    high_water 表記錄每個登錄字號與訓練期間已同步的最新完訓時間，供增量同步使用；
+    fingerprint 表記錄最近一次寫入的 API 回應指紋，內容相同時略過資料庫寫入。
     """
-    headers = {
-        'cookie': cookie_str,
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64)'
-    }
 
-    try:
-        response = requests.post(
-            API_URL,
-            headers=headers,
-            data={
-                'salesregid': item['salesregid'],
-                'finish_start_date': item['finish_start_date'],
-                'finish_end_date': item['finish_end_date']
-            },
-            timeout=REQUEST_TIMEOUT
-        )
-        response.raise_for_status()
+    def __init__(self, path: str = STATE_DB_FILE):
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS high_water (
+                    license TEXT NOT NULL,
+                    begin_date TEXT NOT NULL,
+                    end_date TEXT NOT NULL,
+                    last_finish_ts INTEGER NOT NULL,
+                    boundary_courses TEXT NOT NULL,
+                    row_count INTEGER NOT NULL,
+                    full_synced_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (license, begin_date, end_date)
+                )
+            """)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS fingerprint (
+                    key TEXT PRIMARY KEY,
+                    digest TEXT NOT NULL,
+                    last_used REAL NOT NULL
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS ix_fingerprint_last_used ON fingerprint (last_used)")
+        self._fingerprint_puts = 0
 
-        api_data = response.json()
-        if 'total' not in api_data or 'rows' not in api_data:
-            logging.error(f"API 回應格式不正確: {api_data}")
-            # Cookie 可能已失效
-            clear_cookies()
-            return False
+    @staticmethod
+    def _key(item: Dict) -> Tuple[str, str, str]:
+        return item['salesregid'], item['dTrainBeginDate'], item['dTrainEndDate']
 
-        if api_data['total'] == item['nTotalComplete']:
-            logging.info(f"資料未變化，跳過: {item['salesregid']} (數量: {api_data['total']})")
-            return True
+    def get_high_water(self, item: Dict) -> Optional[Dict]:
+        """取得任務的高水位紀錄，沒有紀錄時回傳 None"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT last_finish_ts, boundary_courses, row_count, full_synced_at FROM high_water "
+                "WHERE license = ? AND begin_date = ? AND end_date = ?",
+                self._key(item)
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            'last_finish_ts': row[0],
+            'boundary_courses': json.loads(row[1]),
+            'row_count': row[2],
+            'full_synced_at': row[3]
+        }
 
-        with get_db_connection() as conn:
-            with conn.cursor() as cursor:
-                delete_details(cursor, item)
-                insert_details(cursor, item, api_data['rows'])
-                update_summary(cursor, item, api_data['total'])
-        return True
+    def _save(self, item: Dict, last_finish_ts: int, boundary_courses: List[str], row_count: int, full_synced_at: float):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO high_water VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                self._key(item) + (last_finish_ts, json.dumps(boundary_courses, ensure_ascii=False),
+                                   row_count, full_synced_at, time.time())
+            )
 
-    except requests.exceptions.RequestException as e:
-        logging.error(f"API請求失敗: {item['salesregid']} - {e}")
-        clear_cookies()  # API 失敗時清除 cookie，強制下次重新登入
-    except pymssql.Error as e:
-        logging.error(f"資料庫操作失敗: {item['salesregid']} - {e}")
-    except Exception as e:
-        logging.error(f"未知錯誤: {item['salesregid']} - {e}")
+    def record_full_sync(self, item: Dict, rows: List[Dict], total: int):
+        """以完整查詢的明細重設高水位"""
+        mark = _high_water_from_rows(rows)
+        if mark is None:
+            logging.warning(f"無法解析完訓時間，不記錄高水位: {item['salesregid']}")
+            return
+        self._save(item, mark[0], mark[1], total, time.time())
 
-    return False
+    def record_increment(self, item: Dict, previous: Dict, new_rows: List[Dict], total: int):
+        """在既有高水位上加入新同步的明細"""
+        mark = _high_water_from_rows(new_rows)
+        if mark is None:
+            self.delete_high_water(item)  # 下次改為完整同步
+            return
+        last_finish_ts, courses = mark
+        if last_finish_ts == previous['last_finish_ts']:
+            courses = sorted(set(courses) | set(previous['boundary_courses']))
+        elif last_finish_ts < previous['last_finish_ts']:
+            last_finish_ts, courses = previous['last_finish_ts'], previous['boundary_courses']
+        self._save(item, last_finish_ts, courses, total, previous['full_synced_at'])
 
-def get_db_connection():
-    """获取数据库连接"""
-    return pymssql.connect(
-        server=os.environ.get('DB_SERVER'),
-        user=os.environ.get('DB_USER'),
-        password=os.environ.get('DB_PASSWORD'),
-        database=os.environ.get('DB_NAME'),
-        autocommit=True,
-        timeout=60
-    )
+    def delete_high_water(self, item: Dict):
+        """刪除任務的高水位紀錄"""
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM high_water WHERE license = ? AND begin_date = ? AND end_date = ?",
+                self._key(item)
+            )
 
-def delete_details(cursor, item: Dict):
-    """刪除指定條件的舊明細資料"""
-    stmt = "DELETE FROM NYDB.AT.InsuExternalTrainingY WHERE cInsuLicense = %s AND dChgDate >= %s AND dChgDate <= %s"
-    params = (item['salesregid'], item['dTrainBeginDate'], item['dTrainEndDate'])
-    cursor.execute(stmt, params)
-    logging.info(f"已刪除舊明細紀錄: {item['salesregid']} 課程年月: {item['cClassYM']}")
-
-def insert_details(cursor, item: Dict, rows: List[Dict]):
-    """批量插入明细数据"""
-    stmt = """
-        INSERT INTO NYDB.AT.InsuExternalTrainingY (
-            cClassYM, cInsuLicense, cEmpIdn, cCourse, dChgDate
-        ) VALUES (
-            %s, %s, NYDB.AT.getEmpIdnByInsuLicence(%s), %s, %s
-        )
+    def get_fingerprint(self, key: str) -> Optional[str]:
+        """取得 API 回應指紋，命中時更新最後使用時間"""
+        with self._lock:
+            row = self._conn.execute("SELECT digest FROM fingerprint WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self._conn.execute("UPDATE fingerprint SET last_used = ? WHERE key = ?", (time.time(), key))
+        return row[0] if row else None
+
+    def put_fingerprint(self, key: str, digest: str):
+        """儲存 API 回應指紋；每寫入一定次數後淘汰最久未使用的紀錄，使筆數不超過 FINGERPRINT_CACHE_SIZE"""
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO fingerprint VALUES (?, ?, ?)", (key, digest, time.time()))
+            self._fingerprint_puts += 1
+            if self._fingerprint_puts % FINGERPRINT_EVICT_EVERY == 0:
+                self._conn.execute(
+                    "DELETE FROM fingerprint WHERE key IN ("
+                    "SELECT key FROM fingerprint ORDER BY last_used "
+                    "LIMIT max(0, (SELECT COUNT(*) FROM fingerprint) - ?))",
+                    (FINGERPRINT_CACHE_SIZE,)
+                )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+_state_store: Optional[StateStore] = None
+_state_store_lock = threading.Lock()
+
+def get_state_store() -> StateStore:
+    """取得全域共用的本機狀態檔 (延遲開啟)"""
+    global _state_store
+    if _state_store is None:
+        with _state_store_lock:
+            if _state_store is None:
+                _state_store = StateStore()
+    return _state_store
+
+def close_state_store():
+    """關閉全域本機狀態檔"""
+    global _state_store
+    with _state_store_lock:
+        if _state_store is not None:
+            _state_store.close()
+            _state_store = None
+
+# --- 中斷續傳 (Checkpoint Journal) ---
+class CheckpointJournal:
+    """
+    本次執行的 append-only 進度紀錄 (每行一個 JSON)。
+    每完成一個任務寫入一行並 flush，累積一定筆數或時間後才 fsync；
+    程序中斷後重新執行時略過已成功的任務，整次執行完成後刪除紀錄檔。
     """
-    params = [
-        (item['cClassYM'], item['salesregid'], item['salesregid'], row['fullname'], row['finish_time'])
-        for row in rows
-    ]
-    if not params:
-        logging.info(f"無新明細可新增: {item['salesregid']}")
-        return
-    cursor.executemany(stmt, params)
-    logging.info(f"已新增 {len(params)} 條新明細紀錄: {item['salesregid']} 課程年月: {item['cClassYM']}")
 
-def update_summary(cursor, item: Dict, total: int):
-    """更新汇总数据"""
-    stmt = "UPDATE NYDB.AT.InsuExternalTrainingX SET nTotalComplete = %s, dRefreshDate = GETDATE() WHERE cInsuLicense = %s AND dTrainBeginDate = %s AND dTrainEndDate = %s"
-    cursor.execute(stmt, (total, item['salesregid'], item['dTrainBeginDate'], item['dTrainEndDate']))
-    logging.info(f"已更新匯總紀錄: {item['salesregid']} 課程年月: {item['cClassYM']}，新總數: {total}")
+    def __init__(self, path: str = CHECKPOINT_FILE, resume: bool = True):
+        self._path = path
+        self._lock = threading.Lock()
+        self._done = set()
+        self._pending_sync = 0
+        self._last_sync = time.monotonic()
+        self.resumed = 0
+        self.exhausted = False
+        header = self._load() if resume else None
+        if header is None:
+            self._run_started = time.time()
+            self._file = open(path, 'w', encoding='utf-8')
+            self._append({'run': self._run_started})
+            self._sync_locked()
+        else:
+            self._run_started = header['run']
+            self._file = open(path, 'a', encoding='utf-8')
+            logging.info(f"從中斷的執行續傳，已完成 {len(self._done)} 個任務 (開始於 {datetime.fromtimestamp(self._run_started, LOCAL_TZ):%Y-%m-%d %H:%M:%S})")
 
-def fetch_tasks() -> list[tuple[Any, ...]] | None | list[Any]:
-    """从数据库获取待处理任务"""
-    try:
-        with get_db_connection() as conn:
-            with conn.cursor(as_dict=True) as cursor:
-                cursor.execute("""
-                    SELECT
-                        A.cInsuLicense as salesregid,
-                        DATEDIFF(second, '1970-01-01', DATEADD(hour, -8, dTrainBeginDate)) as finish_start_date,
-                        DATEDIFF(second, '1970-01-01', DATEADD(hour, -8, DATEADD(day, 1, dTrainEndDate)))-1 as finish_end_date,
-                        CONVERT(VARCHAR(10), dTrainBeginDate, 120) AS dTrainBeginDate,
-                        CONVERT(VARCHAR(10), dTrainEndDate, 120) AS dTrainEndDate,
-                        nTotalComplete,
-                        cClassYM,
-                        cRegNumber
-                    FROM NYDB.AT.InsuExternalTrainingX A
-                    JOIN NYDB.AT.vInsuSalesEmpX B
-                      ON  B.cEmpIdn = A.cEmpIdn
-                      AND B.cWorkingStatus = 'W'
-                    WHERE A.cRegNumber IS NOT NULL
-                    AND   A.nTotalComplete <> nShouldComplete
-                """)
-                return cursor.fetchall()
-    except Exception as e:
-        logging.error(f"獲取任務失敗: {e}")
-        return []
+    def _load(self) -> Optional[Dict]:
+        """讀取既有的紀錄檔，回傳標頭；不存在、損壞或過舊時回傳 None"""
+        try:
+            with open(self._path, encoding='utf-8') as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            return None
+        try:
+            header = json.loads(lines[0])
+        except (IndexError, ValueError):
+            return None
+        if 'run' not in header or time.time() - header['run'] > CHECKPOINT_MAX_AGE:
+            logging.info("上次執行的進度紀錄已過期，重新開始。")
+            return None
+        for line in lines[1:]:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # 中斷時寫到一半的最後一行
+            if record.get('ok'):
+                self._done.add(record['key'])
+            else:
+                self._done.discard(record['key'])
+        return header
 
-def process_single_task(item: Dict, cookie_str: str) -> bool:
-    """处理单个任务"""
-    try:
-        result = sync_data(item, cookie_str)
-        time.sleep(random.uniform(1, 3))
-        return result
-    except Exception as e:
-        logging.error(f"任務處理異常: {item['salesregid']} - {e}")
-        return False
+    def _append(self, record: Dict):
+        self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self._file.flush()  # 程序結束時不遺失；斷電保護交給批次 fsync
+        self._pending_sync += 1
 
-# --- 主執行程序 (Main Execution) ---
-def main():
-    """主程序"""
-    # 1. 檢查或獲取 Cookie
-    cookie_str = get_cookie()
-    if not cookie_str:
-        logging.info("本地無有效 Cookie，執行登入程序。")
-        if not login_and_save_cookie():
-            logging.error("登入失敗，程序終止。")
-            return
-        cookie_str = get_cookie()
-        if not cookie_str:
-            logging.error("即使登入後也無法獲取 Cookie，程序終止。")
-            return
+    def _sync_locked(self):
+        os.fsync(self._file.fileno())
+        self._pending_sync = 0
+        self._last_sync = time.monotonic()
 
-    # 2. 獲取待處理資料
-    tasks = fetch_tasks()
-    if not tasks:
-        logging.info("没有需要處理的資料。")
-        return
+    def record(self, item: Dict, ok: bool):
+        """記錄一個任務的結果"""
+        key = _fingerprint_key(item)
+        with self._lock:
+            if self._file.closed:
+                return
+            self._append({'key': key, 'ok': ok})
+            if ok:
+                self._done.add(key)
+            if (self._pending_sync >= CHECKPOINT_FSYNC_EVERY
+                    or time.monotonic() - self._last_sync >= CHECKPOINT_FSYNC_INTERVAL):
+                self._sync_locked()
 
-    # 3. 同步處理資料
-    total = len(tasks)
-    logging.info(f"開始處理 {total} 條資料")
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        # 使用 lambda 將 cookie_str 傳遞給 process_single_task
-        results = list(executor.map(lambda task: process_single_task(task, cookie_str), tasks))
-    
-    success_count = sum(results)
-    logging.info(f"處理完成: 成功 {success_count}/{total} 條")
+    def resume(self, tasks: Iterable[Dict]) -> Iterator[Dict]:
+        """略過上次已成功的任務；任務來源讀完時設定 exhausted"""
+        for item in tasks:
+            if _fingerprint_key(item) in self._done:
+                self.resumed += 1
+                continue
+            yield item
+        self.exhausted = True
+
+    def _compact_locked(self):
+        """以已成功任務的清單改寫紀錄檔，去除重複與失敗的紀錄"""
+        tmp_path = f"{self._path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'run': self._run_started}) + '\n')
+            for key in sorted(self._done):
+                f.write(json.dumps({'key': key, 'ok': True}, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._path)
+
+    def close(self, completed: bool):
+        """
+        結束本次執行的紀錄
+        :param completed: 所有任務都已派發處理；是則刪除紀錄檔，否則壓縮後保留供下次續傳
+        """
+        with self._lock:
+            if self._file.closed:
+                return
+            self._sync_locked()
+            self._file.close()
+            if completed:
+                os.remove(self._path)
+            else:
+                self._compact_locked()
+                logging.info(f"執行未完成，已保存進度 ({len(self._done)} 個任務已完成)，下次執行將續傳。")
+
+_checkpoint: Optional[CheckpointJournal] = None
+
+def _record_checkpoint(item: Dict, ok: bool):
+    """啟用中斷續傳時記錄任務結果"""
+    if _checkpoint is not None:
+        _checkpoint.record(item, ok)
+
+# --- 失敗分類與重試 (Failure Classification and Retry) ---
+class TransientSyncError(Exception):
+    """可重試的暫時性失敗 (逾時、連線中斷、5xx、資料庫死結)"""
+
+    def __init__(self, kind: str, cause: Exception):
+        super().__init__(f"{kind}: {cause}")
+        self.kind = kind
+
+class RetryLater(Exception):
+    """任務應在 delay 秒後重新放回工作佇列"""
+
+    def __init__(self, delay: float):
+        super().__init__(f"retry in {delay:.1f}s")
+        self.delay = delay
+
+def classify_failure(exc: Exception) -> str:
+    """
+    將失敗分類為 auth / timeout / connection / server_error / deadlock / client_error / database / other，
+    其中 TRANSIENT_FAILURES 中的類別可重試
+    """
+    if isinstance(exc, SessionExpiredError):
+        return 'auth'
+    if isinstance(exc, requests.exceptions.RequestException):
+        cause = exc.__cause__  # 非同步模式由 aiohttp 錯誤轉換而來
+        wrapped = exc.args[0] if exc.args else None
+        reason = wrapped.reason if isinstance(wrapped, MaxRetryError) else None  # urllib3 重試用盡時包裝的原始錯誤
+        if (isinstance(exc, requests.exceptions.Timeout) or isinstance(cause, asyncio.TimeoutError)
+                or isinstance(reason, ReadTimeoutError)):
+            return 'timeout'
+        status = _api_error_status(exc)
+        if status is not None:
+            return 'server_error' if status == 429 or status >= 500 else 'client_error'
+        return 'connection'
+    if isinstance(exc, pymssql.Error):
+        code = exc.args[0] if exc.args and isinstance(exc.args[0], int) else None
+        if code in DB_DEADLOCK_ERRORS:
+            return 'deadlock'
+        if code in DB_CONNECTION_ERRORS or isinstance(exc, pymssql.InterfaceError):
+            return 'connection'
+        return 'database'
+    return 'other'
+
+def _raise_if_transient(exc: Exception):
+    """暫時性失敗轉為 TransientSyncError，交由任務層決定是否重試"""
+    kind = classify_failure(exc)
+    if kind in TRANSIENT_FAILURES:
+        raise TransientSyncError(kind, exc) from exc
+
+class RetryPolicy:
+    """
+    暫時性失敗的重試策略：指數退避加上隨機抖動，單一任務最多嘗試 max_attempts 次，
+    並統計各類失敗的重試次數與任務最終的嘗試次數分布。
+    """
+
+    def __init__(self, max_attempts: int = RETRY_MAX_ATTEMPTS, base_delay: float = RETRY_BASE_DELAY,
+                 max_delay: float = RETRY_MAX_DELAY):
+        self._max_attempts = max_attempts
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._lock = threading.Lock()
+        self._retries: Counter = Counter()
+        self._attempts: Counter = Counter()
+        self._gave_up = 0
+        self._batch_failed = 0
+
+    def next_delay(self, attempt: int, kind: str) -> Optional[float]:
+        """
+        第 attempt 次嘗試失敗後的等待秒數
+        :return: 等待秒數；已達嘗試上限時回傳 None
+        """
+        if attempt >= self._max_attempts:
+            return None
+        with self._lock:
+            self._retries[kind] += 1
+        delay = min(self._max_delay, self._base_delay * 2 ** (attempt - 1))
+        return delay * random.uniform(0.5, 1.5)  # 抖動，避免同一波失敗的任務同時重試
+
+    def record_result(self, attempt: int, ok: bool):
+        """記錄任務最終結果 (成功或放棄重試) 所用的嘗試次數"""
+        with self._lock:
+            self._attempts[attempt] += 1
+            if not ok and attempt > 1:
+                self._gave_up += 1
+
+    def record_batch_failure(self, count: int):
+        """記錄已回報成功、但所在批次寫入失敗的任務數"""
+        with self._lock:
+            self._batch_failed += count
+
+    def stats(self) -> Dict[str, Any]:
+        """回傳重試統計：各類失敗的重試次數、任務嘗試次數分布、重試後仍失敗的任務數、批次寫入失敗的任務數"""
+        with self._lock:
+            return {
+                'retries': dict(self._retries),
+                'attempts': dict(sorted(self._attempts.items())),
+                'gave_up': self._gave_up,
+                'batch_failed': self._batch_failed
+            }
+
+_retry_policy = RetryPolicy()
+
+def get_retry_policy() -> RetryPolicy:
+    """取得目前的重試策略"""
+    return _retry_policy
+
+def configure_retry_policy(max_attempts: int = RETRY_MAX_ATTEMPTS) -> RetryPolicy:
+    """以指定的嘗試上限重新建立重試策略 (同時重設統計)"""
+    global _retry_policy
+    _retry_policy = RetryPolicy(max_attempts=max_attempts)
+    return _retry_policy
+
+# --- 核心同步邏輯 (Core Synchronization Logic) ---
+def _api_headers(cookie_str: str) -> Dict[str, str]:
+    """組成 API 請求標頭"""
+    return {
+        'cookie': cookie_str,
+        'User-Agent': USER_AGENT
+    }
+
+def _api_payload(item: Dict) -> Dict[str, Any]:
+    """組成 API 查詢參數"""
+    return {
+        'salesregid': item['salesregid'],
+        'finish_start_date': item['finish_start_date'],
+        'finish_end_date': item['finish_end_date']
+    }
+
+def _check_api_data(api_data: Dict):
+    """確認 API 回應包含 total/rows，否則視為 session 失效"""
+    if 'total' not in api_data or 'rows' not in api_data:
+        logging.error(f"API 回應格式不正確: {api_data}")
+        # Cookie 可能已失效，交由 SessionManager 重新登入後重試
+        raise SessionExpiredError("API 回應缺少 total/rows")
+
+def _handle_api_data(item: Dict, api_data: Dict, after_commit: Optional[Callable[[], None]] = None) -> bool:
+    """
+    檢查 API 回應，資料有變化時寫入資料庫
+    :param item: 任務資料
+    :param api_data: API 回應的 JSON 內容
+    :param after_commit: 資料確定寫入 (或確認未變化) 後呼叫
+    :return: 是否同步成功
+    """
+    _check_api_data(api_data)
+    after_commit = _chain_callbacks(after_commit, lambda: _record_checkpoint(item, True))
+
+    if _fingerprint_cache:
+        store = get_state_store()
+        key = _fingerprint_key(item)
+        digest = _rows_fingerprint(api_data['rows'], api_data['total'])
+        previous = store.get_fingerprint(key)
+        if previous is None:
+            # 沒有指紋紀錄時沿用數量比對，未變化則以本次內容作為基準
+            unchanged = api_data['total'] == item['nTotalComplete']
+            if unchanged:
+                store.put_fingerprint(key, digest)
+        else:
+            unchanged = previous == digest
+        if not unchanged:
+            after_commit = _chain_callbacks(lambda: store.put_fingerprint(key, digest), after_commit)
+    else:
+        unchanged = api_data['total'] == item['nTotalComplete']
+
+    if unchanged:
+        task_log.info("資料未變化，跳過: %s (數量: %s)", item['salesregid'], api_data['total'])
+        get_metrics().inc('tasks_skipped')
+        after_commit()
+        return True
+
+    write_changes(item, api_data, after_commit)
+    get_metrics().inc('tasks_changed')
+    return True
+
+def _chain_callbacks(*callbacks: Optional[Callable[[], None]]) -> Callable[[], None]:
+    """將多個回呼依序合併為一個，忽略 None"""
+    def run():
+        for callback in callbacks:
+            if callback is not None:
+                callback()
+    return run
+
+def _fingerprint_key(item: Dict) -> str:
+    """指紋快取的鍵：登錄字號 + 查詢期間"""
+    return f"{item['salesregid']}|{item['finish_start_date']}|{item['finish_end_date']}"
+
+def _rows_fingerprint(rows: List[Dict], total: int) -> str:
+    """將明細正規化 (去空白、統一時間格式、排序) 後計算雜湊，順序不同但內容相同視為一致"""
+    normalized = sorted((row['fullname'].strip(), _normalize_finish_time(row['finish_time'])) for row in rows)
+    payload = json.dumps([total, normalized], ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+def write_changes(item: Dict, api_data: Dict, after_commit: Optional[Callable[[], None]] = None):
+    """
+    寫入資料變化：啟用批次寫入時放入批次佇列，否則以單一連線更新明細 (全部重寫或差異比對) 與匯總
+    :param item: 任務資料
+    :param api_data: API 回應的 JSON 內容
+    :param after_commit: 寫入完成後呼叫；批次寫入時在該批次提交後才呼叫
+    """
+    if _batch_writer is not None:
+        _batch_writer.submit(item, api_data['rows'], api_data['total'], after_commit)
+        return
+    with get_db_pool().connection() as conn:
+        with conn.cursor() as cursor:
+            if _write_mode == 'diff':
+                reconcile_details(cursor, item, api_data['rows'])
+            else:
+                delete_details(cursor, item)
+                insert_details(cursor, item, api_data['rows'])
+            update_summary(cursor, item, api_data['total'])
+    if after_commit is not None:
+        after_commit()
+
+def _prepare_request(item: Dict) -> Tuple[Dict[str, Any], Callable[[Dict], bool]]:
+    """
+    決定一個任務的 API 查詢參數與回應處理方式 (同步與非同步模式共用)
+    :return: (查詢參數, 處理 API 回應並回傳是否成功的函式)
+    """
+    if not _incremental:
+        return _api_payload(item), lambda api_data: _handle_api_data(item, api_data)
+
+    store = get_state_store()
+    mark = store.get_high_water(item)
+    if mark is None or time.time() - mark['full_synced_at'] > INCREMENTAL_FULL_SYNC_INTERVAL:
+        # 第一次同步或距上次完整同步過久：完整查詢並記錄高水位
+        def handle_full(api_data: Dict) -> bool:
+            return _handle_api_data(item, api_data, lambda: store.record_full_sync(item, api_data['rows'], api_data['total']))
+        return _api_payload(item), handle_full
+
+    payload = dict(_api_payload(item), finish_start_date=max(int(item['finish_start_date']), mark['last_finish_ts']))
+    return payload, lambda api_data: _handle_incremental_data(item, api_data, mark)
+
+def _api_error_status(exc: Exception) -> Optional[int]:
+    """取得失敗請求的 HTTP 狀態碼，逾時或連線失敗時回傳 None"""
+    response = getattr(exc, 'response', None)
+    if response is not None:
+        return response.status_code
+    return getattr(exc.__cause__, 'status', None)
+
+def _post_api(item: Dict, cookie_str: str, payload: Optional[Dict[str, Any]] = None) -> requests.Response:
+    """經由速率控制器送出 API 請求，並回報回應時間與狀態；payload 預設為任務的完整查詢期間"""
+    limiter = get_rate_limiter()
+    metrics = get_metrics()
+    with metrics.timer('sleep'):
+        limiter.acquire()
+    started = time.monotonic()
+    try:
+        response = get_http_session().post(
+            API_URL,
+            headers=_api_headers(cookie_str),
+            data=payload or _api_payload(item),
+            timeout=REQUEST_TIMEOUT,
+            allow_redirects=False  # 被導向登入頁代表 session 失效，不跟隨
+        )
+    except requests.exceptions.RequestException as e:
+        metrics.observe('http_request', time.monotonic() - started)
+        limiter.record(time.monotonic() - started, _api_error_status(e), failed=True)
+        raise
+    metrics.observe('http_request', time.monotonic() - started)
+    limiter.record(time.monotonic() - started, response.status_code, failed=not response.ok)
+    return response
+
+def _parse_api_response(response: requests.Response) -> Dict:
+    """
+    檢查 HTTP 狀態並解析 JSON
+    :raises SessionExpiredError: 回應為 401/403、被導向登入頁或不是 JSON 內容
+    """
+    if response.status_code in (401, 403) or response.is_redirect:
+        raise SessionExpiredError(f"HTTP {response.status_code}")
+    response.raise_for_status()
+    try:
+        with get_metrics().timer('json_decode'):
+            return response.json()
+    except ValueError:
+        raise SessionExpiredError("API 回應不是 JSON (可能為登入頁面)")
+
+def _note_paging(applied: bool):
+    """記錄伺服器是否套用分頁參數；未套用時本次執行不再使用 count probe 與分頁查詢"""
+    global _paging_supported
+    if applied:
+        if _paging_supported is None:
+            _paging_supported = True
+    elif _paging_supported is not False:
+        _paging_supported = False
+        logging.warning(f"API 未套用分頁參數 {'/'.join(_api_page_fields)}，停用 count probe 與分頁查詢")
+
+def _use_count_probe() -> bool:
+    """
+    是否先以 count probe 查詢數量。增量同步與指紋比對需要完整明細才能判斷是否變化，不使用 probe
+    """
+    return _count_probe and _paging_supported is not False and not _incremental and not _fingerprint_cache
+
+def _probe_payload(item: Dict) -> Dict[str, Any]:
+    """只要求一筆明細的查詢參數，用於取得 total"""
+    limit_field, offset_field = _api_page_fields
+    return dict(_api_payload(item), **{limit_field: 1, offset_field: 0})
+
+def _accept_probe(item: Dict, api_data: Dict) -> bool:
+    """
+    判斷 count probe 的回應是否足以處理任務，不足時需再查詢完整明細
+    :return: 回應已包含全部明細，或數量與資料庫相同 (處理時會略過寫入)
+    """
+    _check_api_data(api_data)
+    metrics = get_metrics()
+    metrics.inc('count_probes')
+    rows = api_data['rows']
+    if len(rows) > 1:
+        # 伺服器忽略分頁參數，本次回應即完整明細
+        _note_paging(False)
+        return True
+    if len(rows) >= api_data['total']:
+        return True
+    _note_paging(True)
+    if api_data['total'] != item['nTotalComplete']:
+        # 數量有變化時仍須下載完整明細，probe 回應成為額外的成本
+        metrics.inc('count_probe_misses')
+        metrics.inc('count_probe_bytes_wasted', len(json.dumps(api_data).encode('utf-8')))
+        return False
+    # 以 probe 取得的明細長度估計省下的回應大小
+    row_bytes = len(json.dumps(rows[0]).encode('utf-8')) + 1 if rows else 0
+    metrics.inc('count_probe_skips')
+    metrics.inc('count_probe_bytes_saved', (api_data['total'] - len(rows)) * row_bytes)
+    return True
+
+def _page_payloads(payload: Dict[str, Any], first: int, count: int) -> List[Dict[str, Any]]:
+    """第 first 頁起 count 頁的分頁查詢參數"""
+    limit_field, offset_field = _api_page_fields
+    return [
+        dict(payload, **{limit_field: FETCH_PAGE_SIZE, offset_field: page * FETCH_PAGE_SIZE})
+        for page in range(first, first + count)
+    ]
+
+def _window_payloads(payload: Dict[str, Any], parts: int) -> List[Dict[str, Any]]:
+    """將查詢期間 (含起訖秒數) 切分為 parts 段互不重疊的子區間"""
+    start, end = int(payload['finish_start_date']), int(payload['finish_end_date'])
+    parts = max(1, min(parts, end - start + 1))
+    bounds = [start + (end - start + 1) * i // parts for i in range(parts)] + [end + 1]
+    return [dict(payload, finish_start_date=lo, finish_end_date=hi - 1) for lo, hi in zip(bounds, bounds[1:])]
+
+def _plan_fetch(item: Dict, payload: Dict[str, Any], expected: int) -> Tuple[str, List[Dict[str, Any]]]:
+    """
+    決定查詢方式。auto 時依預期明細數選擇：少量明細一次查詢，大量明細優先分頁，伺服器不支援分頁時切分時間區間
+    :param expected: 預期明細數 (上次同步的數量，或 count probe 取得的 total)
+    :return: (single/pages/windows, 第一輪的查詢參數)
+    """
+    if int(payload['finish_start_date']) != int(item['finish_start_date']):
+        return 'single', [payload]  # 增量查詢只包含上次同步之後的新紀錄
+    strategy = _fetch_strategy
+    if strategy == 'auto':
+        strategy = 'single' if expected < LARGE_FETCH_ROWS else 'pages'
+    if strategy == 'pages' and _paging_supported is False:
+        strategy = 'windows'
+    parts = min(FETCH_MAX_PARTS, -(-expected // FETCH_PAGE_SIZE))
+    if strategy == 'single' or parts <= 1:
+        return 'single', [payload]
+    if strategy == 'pages':
+        # 尚未確認伺服器支援分頁時先只查第一頁，避免每一頁都收到完整明細
+        return strategy, _page_payloads(payload, 0, parts if _paging_supported else 1)
+    return strategy, _window_payloads(payload, parts)
+
+def _merge_parts(strategy: str, payload: Dict[str, Any], responses: List[Dict]) -> Tuple[Optional[Dict], List[Dict[str, Any]]]:
+    """
+    合併分段查詢的回應
+    :return: (合併後的 API 回應, 尚需查詢的分頁參數)；分頁期間資料有變動時回傳 (None, [])，改為一次查詢
+    """
+    if strategy == 'single':
+        return responses[0], []
+    if strategy == 'windows':
+        # 伺服器若將查詢起點取整到日，相鄰子區間會重疊；以 (課程, 完訓時間) 去除重複
+        rows = list({(row['fullname'], row['finish_time']): row for part in responses for row in part['rows']}.values())
+        return {'total': len(rows), 'rows': rows}, []
+
+    oversized = next((part for part in responses if len(part['rows']) > FETCH_PAGE_SIZE), None)
+    if oversized is not None:
+        _note_paging(False)
+        return oversized, []  # 伺服器忽略分頁參數，回應即完整明細
+    totals = {part['total'] for part in responses}
+    if len(totals) != 1:
+        return None, []
+    total = totals.pop()
+    if total > FETCH_PAGE_SIZE:
+        _note_paging(True)
+    pages = -(-total // FETCH_PAGE_SIZE)
+    if pages > len(responses):
+        return None, _page_payloads(payload, len(responses), min(FETCH_MAX_PARTS, pages - len(responses)))
+    rows = [row for part in responses for row in part['rows']]
+    if len(rows) != total:
+        return None, []
+    return {'total': total, 'rows': rows}, []
+
+def _fetch_part(item: Dict, cookie_str: str, payload: Dict[str, Any]) -> Dict:
+    """送出一次 API 查詢並檢查回應格式"""
+    api_data = _parse_api_response(_post_api(item, cookie_str, payload))
+    _check_api_data(api_data)
+    return api_data
+
+def _fetch_full(item: Dict, cookie_str: str, payload: Dict[str, Any], expected: int) -> Dict:
+    """
+    查詢完整明細；明細量大時以分頁或切分時間區間的方式同時送出多個較小的請求後合併
+    :param expected: 預期明細數
+    """
+    strategy, parts = _plan_fetch(item, payload, expected)
+    responses: List[Dict] = []
+    api_data = None
+    while parts:
+        if len(parts) == 1:
+            responses.append(_fetch_part(item, cookie_str, parts[0]))
+        else:
+            with ThreadPoolExecutor(max_workers=len(parts), thread_name_prefix='sync-part') as executor:
+                responses.extend(executor.map(lambda part: _fetch_part(item, cookie_str, part), parts))
+        api_data, parts = _merge_parts(strategy, payload, responses)
+    if strategy != 'single':
+        _record_split_fetch(item, strategy, len(responses), api_data is None)
+    if api_data is None:
+        api_data = _fetch_part(item, cookie_str, payload)
+    return api_data
+
+def _record_split_fetch(item: Dict, strategy: str, parts: int, inconsistent: bool):
+    """記錄分段查詢統計"""
+    metrics = get_metrics()
+    metrics.inc(f'fetch_{strategy}')
+    metrics.inc('fetch_parts', parts)
+    if inconsistent:
+        metrics.inc('fetch_split_fallbacks')
+        logging.warning(f"分頁查詢期間資料有變動，改為一次查詢: {item['salesregid']}")
+    else:
+        task_log.info("分段查詢 (%s): %s，共 %d 段", strategy, item['salesregid'], parts)
+
+def fetch_api_data(item: Dict, cookie_str: str) -> Tuple[Callable[[Dict], bool], Dict]:
+    """
+    查詢單一任務的 API 資料 (不寫入資料庫)；啟用 count probe 時先只查詢數量，有變化才查詢完整明細
+    :return: (處理 API 回應並寫入資料庫的函式, API 回應)
+    :raises SessionExpiredError: session 已失效
+    """
+    payload, handle = _prepare_request(item)
+    expected = item['nTotalComplete']
+    if _use_count_probe():
+        api_data = _fetch_part(item, cookie_str, _probe_payload(item))
+        if _accept_probe(item, api_data):
+            return handle, api_data
+        expected = api_data['total']
+    return handle, _fetch_full(item, cookie_str, payload, expected)
+
+def sync_data(item: Dict, cookie_str: str) -> bool:
+    """
+    同步單條資料到資料庫
+    :param item: 包含銷售登記ID和日期範圍的資料字典
+    :param cookie_str: 用於驗證的 Cookie
+    :return: 是否同步成功
+    :raises SessionExpiredError: session 已失效，需重新登入後重試
+    :raises TransientSyncError: 暫時性失敗，可稍後重試
+    """
+    try:
+        handle, api_data = fetch_api_data(item, cookie_str)
+        return handle(api_data)
+
+    except SessionExpiredError:
+        raise
+    except requests.exceptions.RequestException as e:
+        _raise_if_transient(e)
+        logging.error(f"API請求失敗: {item['salesregid']} - {e}")
+    except pymssql.Error as e:
+        _raise_if_transient(e)
+        logging.error(f"資料庫操作失敗: {item['salesregid']} - {e}")
+    except Exception as e:
+        logging.error(f"未知錯誤: {item['salesregid']} - {e}")
+
+    return False
+
+def get_db_connection():
+    """获取数据库连接"""
+    return pymssql.connect(
+        server=os.environ.get('DB_SERVER'),
+        user=os.environ.get('DB_USER'),
+        password=os.environ.get('DB_PASSWORD'),
+        database=os.environ.get('DB_NAME'),
+        autocommit=True,
+        timeout=60
+    )
+
+# --- 資料庫連線池 (Database Connection Pool) ---
+class DBConnectionPool:
+    """
+    有上限、執行緒安全的資料庫連線池。
+    借出前對閒置較久的連線做健康檢查，閒置過久的連線會被回收，損壞的連線會被丟棄並重新建立。
+    """
+
+    def __init__(self, factory=get_db_connection, min_size: int = DB_POOL_MIN_SIZE,
+                 max_size: int = DB_POOL_MAX_SIZE, idle_timeout: float = DB_POOL_IDLE_TIMEOUT,
+                 health_check_after: float = DB_POOL_HEALTH_CHECK_AFTER,
+                 acquire_timeout: float = DB_POOL_ACQUIRE_TIMEOUT):
+        self._factory = factory
+        self._min_size = min_size
+        self._max_size = max_size
+        self._idle_timeout = idle_timeout
+        self._health_check_after = health_check_after
+        self._acquire_timeout = acquire_timeout
+        self._idle = deque()  # (conn, last_used)
+        self._size = 0        # 已開啟的連線數 (閒置 + 借出)
+        self._in_use = 0
+        self._cond = threading.Condition()
+        self._counters = {
+            'created': 0, 'reused': 0, 'waits': 0, 'health_check_failures': 0,
+            'evicted': 0, 'discarded': 0, 'peak_in_use': 0
+        }
+
+    def _evict_idle_locked(self, now: float) -> List:
+        """移除閒置過久的連線 (需持有鎖)，回傳待關閉的連線"""
+        expired = []
+        while self._idle and self._size > self._min_size and now - self._idle[0][1] > self._idle_timeout:
+            conn, _ = self._idle.popleft()
+            self._size -= 1
+            self._counters['evicted'] += 1
+            expired.append(conn)
+        return expired
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    @staticmethod
+    def _is_healthy(conn) -> bool:
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+                cursor.fetchone()
+            return True
+        except Exception:
+            return False
+
+    def _release_slot(self):
+        with self._cond:
+            self._size -= 1
+            self._in_use -= 1
+            self._cond.notify()
+
+    def acquire(self):
+        """借出一條連線；連線池已滿時最多等待 acquire_timeout 秒"""
+        deadline = time.monotonic() + self._acquire_timeout
+        while True:
+            conn, last_used = None, None
+            with self._cond:
+                now = time.monotonic()
+                expired = self._evict_idle_locked(now)
+                if self._idle:
+                    conn, last_used = self._idle.pop()  # 後進先出，優先使用最熱的連線
+                elif self._size < self._max_size:
+                    self._size += 1
+                else:
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        raise TimeoutError(f"等待資料庫連線超時 ({self._acquire_timeout} 秒)")
+                    self._counters['waits'] += 1
+                    self._cond.wait(remaining)
+                    continue
+                self._in_use += 1
+                self._counters['peak_in_use'] = max(self._counters['peak_in_use'], self._in_use)
+            for old in expired:
+                self._close_quietly(old)
+
+            if conn is None:
+                try:
+                    conn = self._factory()
+                except Exception:
+                    self._release_slot()
+                    raise
+                with self._cond:
+                    self._counters['created'] += 1
+                return conn
+
+            if time.monotonic() - last_used < self._health_check_after or self._is_healthy(conn):
+                with self._cond:
+                    self._counters['reused'] += 1
+                return conn
+
+            logging.warning("資料庫連線健康檢查失敗，重新建立連線。")
+            self._close_quietly(conn)
+            with self._cond:
+                self._counters['health_check_failures'] += 1
+            self._release_slot()
+
+    def release(self, conn, broken: bool = False):
+        """歸還連線；broken=True 時直接關閉，讓下次借出時重建"""
+        if broken:
+            self._close_quietly(conn)
+            with self._cond:
+                self._counters['discarded'] += 1
+            self._release_slot()
+            return
+        with self._cond:
+            self._in_use -= 1
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """以 with 語法借出連線，區塊結束後自動歸還"""
+        conn = self.acquire()
+        broken = False
+        try:
+            yield conn
+        except (pymssql.OperationalError, pymssql.InterfaceError):
+            broken = True  # 連線層級錯誤，此連線不再重用
+            raise
+        finally:
+            self.release(conn, broken)
+
+    def close(self):
+        """關閉所有閒置連線"""
+        with self._cond:
+            idle = [conn for conn, _ in self._idle]
+            self._idle.clear()
+            self._size -= len(idle)
+        for conn in idle:
+            self._close_quietly(conn)
+
+    @property
+    def max_size(self) -> int:
+        """連線數上限"""
+        return self._max_size
+
+    def stats(self) -> Dict[str, int]:
+        """回傳連線池統計資料"""
+        with self._cond:
+            return dict(self._counters, size=self._size, idle=len(self._idle), in_use=self._in_use)
+
+_db_pool: Optional[DBConnectionPool] = None
+_db_pool_lock = threading.Lock()
+
+def get_db_pool() -> DBConnectionPool:
+    """取得全域共用的資料庫連線池 (延遲建立)"""
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                _db_pool = DBConnectionPool()
+    return _db_pool
+
+def close_db_pool():
+    """關閉全域資料庫連線池，並在日誌中輸出統計資料"""
+    global _db_pool
+    with _db_pool_lock:
+        if _db_pool is not None:
+            logging.info(f"資料庫連線池統計: {_db_pool.stats()}")
+            _db_pool.close()
+            _db_pool = None
+
+@contextmanager
+def db_transaction(conn):
+    """在單一交易中執行區塊內的語句，區塊正常結束時提交，發生例外時回滾"""
+    conn.autocommit(False)
+    try:
+        with conn.cursor() as cursor:
+            yield cursor
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.autocommit(True)
+
+def delete_details(cursor, item: Dict):
+    """刪除指定條件的舊明細資料"""
+    stmt = "DELETE FROM NYDB.AT.InsuExternalTrainingY WHERE cInsuLicense = %s AND dChgDate >= %s AND dChgDate <= %s"
+    params = (item['salesregid'], item['dTrainBeginDate'], item['dTrainEndDate'])
+    with get_metrics().timer('delete'):
+        cursor.execute(stmt, params)
+    task_log.info("已刪除舊明細紀錄: %s 課程年月: %s", item['salesregid'], item['cClassYM'])
+
+def insert_details(cursor, item: Dict, rows: List[Dict], skip_existing: bool = False):
+    """
+    批量插入明细数据
+    :param skip_existing: 略過已存在的明細 (同一登錄字號、課程與完訓時間)，重試時不會重複新增
+    """
+    if skip_existing:
+        stmt = """
+            INSERT INTO NYDB.AT.InsuExternalTrainingY (
+                cClassYM, cInsuLicense, cEmpIdn, cCourse, dChgDate
+            )
+            SELECT %s, %s, NYDB.AT.getEmpIdnByInsuLicence(%s), %s, %s
+            WHERE NOT EXISTS (
+                SELECT 1 FROM NYDB.AT.InsuExternalTrainingY
+                WHERE cInsuLicense = %s AND cCourse = %s AND dChgDate = %s
+            )
+        """
+        params = [
+            (item['cClassYM'], item['salesregid'], item['salesregid'], row['fullname'], row['finish_time'],
+             item['salesregid'], row['fullname'], row['finish_time'])
+            for row in rows
+        ]
+    else:
+        stmt = """
+            INSERT INTO NYDB.AT.InsuExternalTrainingY (
+                cClassYM, cInsuLicense, cEmpIdn, cCourse, dChgDate
+            ) VALUES (
+                %s, %s, NYDB.AT.getEmpIdnByInsuLicence(%s), %s, %s
+            )
+        """
+        params = [
+            (item['cClassYM'], item['salesregid'], item['salesregid'], row['fullname'], row['finish_time'])
+            for row in rows
+        ]
+    if not params:
+        task_log.info("無新明細可新增: %s", item['salesregid'])
+        return
+    with get_metrics().timer('insert'):
+        cursor.executemany(stmt, params)
+    get_metrics().inc('rows_written', len(params))
+    task_log.info("已新增 %d 條新明細紀錄: %s 課程年月: %s", len(params), item['salesregid'], item['cClassYM'])
+
+def _normalize_finish_time(value) -> str:
+    """將 API 的 finish_time 與資料庫的 dChgDate 統一為 'YYYY-MM-DD HH:MM:SS' 以便比對"""
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    text = str(value).strip()
+    if text.isdigit():  # Unix 時間戳記
+        return datetime.fromtimestamp(int(text), LOCAL_TZ).strftime('%Y-%m-%d %H:%M:%S')
+    try:
+        return datetime.fromisoformat(text.replace('/', '-')).strftime('%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        return text
+
+def load_existing_details(cursor, item: Dict) -> List[tuple]:
+    """讀取指定條件下現有的明細 (cCourse, dChgDate)"""
+    stmt = "SELECT cCourse, dChgDate FROM NYDB.AT.InsuExternalTrainingY WHERE cInsuLicense = %s AND dChgDate >= %s AND dChgDate <= %s"
+    cursor.execute(stmt, (item['salesregid'], item['dTrainBeginDate'], item['dTrainEndDate']))
+    return [(row[0], row[1]) for row in cursor.fetchall()]
+
+def reconcile_details(cursor, item: Dict, rows: List[Dict]):
+    """
+    比對現有明細與 API 明細，只新增新出現的、刪除已消失的明細，其餘不動
+    :param cursor: 資料庫游標
+    :param item: 任務資料
+    :param rows: API 回傳的明細
+    """
+    existing_values = {}
+    existing = Counter()
+    for course, chg_date in load_existing_details(cursor, item):
+        key = (course.strip(), _normalize_finish_time(chg_date))
+        existing[key] += 1
+        existing_values[key] = (course, chg_date)
+
+    wanted = Counter((row['fullname'].strip(), _normalize_finish_time(row['finish_time'])) for row in rows)
+    vanished = existing - wanted
+    added = wanted - existing
+
+    if vanished:
+        stmt = "DELETE TOP (%s) FROM NYDB.AT.InsuExternalTrainingY WHERE cInsuLicense = %s AND cCourse = %s AND dChgDate = %s"
+        with get_metrics().timer('delete'):
+            cursor.executemany(stmt, [
+                (count, item['salesregid']) + existing_values[key]
+                for key, count in vanished.items()
+            ])
+
+    new_rows = []
+    for row in rows:
+        key = (row['fullname'].strip(), _normalize_finish_time(row['finish_time']))
+        if added[key] > 0:
+            added[key] -= 1
+            new_rows.append(row)
+    if new_rows:
+        insert_details(cursor, item, new_rows)
+
+    unchanged = sum((existing & wanted).values())
+    task_log.info(
+        "明細差異比對: %s 課程年月: %s，新增 %d 條，刪除 %d 條，未變 %d 條",
+        item['salesregid'], item['cClassYM'], len(new_rows), sum(vanished.values()), unchanged
+    )
+
+def _finish_time_epoch(value) -> Optional[int]:
+    """將 finish_time 換算為 Unix 秒 (與 finish_start_date 相同基準)，無法解析時回傳 None"""
+    if isinstance(value, (int, float)) or str(value).strip().isdigit():
+        return int(value)
+    try:
+        return int(datetime.fromisoformat(_normalize_finish_time(value)).replace(tzinfo=LOCAL_TZ).timestamp())
+    except ValueError:
+        return None
+
+def _high_water_from_rows(rows: List[Dict]) -> Optional[Tuple[int, List[str]]]:
+    """
+    計算明細中最新的完訓時間，以及在該時間點完訓的課程 (用於下次查詢時排除重複)
+    :return: (最新完訓時間, 課程清單)；有無法解析的 finish_time 時回傳 None
+    """
+    stamps = [(_finish_time_epoch(row['finish_time']), row['fullname']) for row in rows]
+    if any(ts is None for ts, _ in stamps):
+        return None
+    if not stamps:
+        return 0, []
+    latest = max(ts for ts, _ in stamps)
+    return latest, sorted({course for ts, course in stamps if ts == latest})
+
+def _handle_incremental_data(item: Dict, api_data: Dict, mark: Dict) -> bool:
+    """
+    處理增量查詢的回應：排除高水位時間點上已同步的課程，只新增新的完訓紀錄並更新匯總
+    :param item: 任務資料
+    :param api_data: 以高水位為起點查詢的 API 回應
+    :param mark: 該任務目前的高水位紀錄
+    :return: 是否同步成功
+    """
+    _check_api_data(api_data)
+    boundary = set(mark['boundary_courses'])
+
+    def already_synced(row: Dict) -> bool:
+        # 伺服器可能將查詢起點取整到日，早於高水位的紀錄都已同步過
+        finish_ts = _finish_time_epoch(row['finish_time'])
+        if finish_ts is None:
+            return False
+        return finish_ts < mark['last_finish_ts'] or (finish_ts == mark['last_finish_ts'] and row['fullname'] in boundary)
+
+    new_rows = [row for row in api_data['rows'] if not already_synced(row)]
+    if not new_rows:
+        task_log.info("無新完訓紀錄，跳過: %s (高水位: %s)", item['salesregid'], mark['last_finish_ts'])
+        get_metrics().inc('tasks_skipped')
+        _record_checkpoint(item, True)
+        return True
+
+    total = mark['row_count'] + len(new_rows)
+    # 新增與匯總在同一交易中提交；高水位在提交後才前進，重試時以 NOT EXISTS 略過已新增的明細
+    with get_db_pool().connection() as conn, db_transaction(conn) as cursor:
+        insert_details(cursor, item, new_rows, skip_existing=True)
+        update_summary(cursor, item, total)
+    get_state_store().record_increment(item, mark, new_rows, total)
+    get_metrics().inc('tasks_changed')
+    _record_checkpoint(item, True)
+    return True
+
+def update_summary(cursor, item: Dict, total: int):
+    """更新汇总数据"""
+    stmt = "UPDATE NYDB.AT.InsuExternalTrainingX SET nTotalComplete = %s, dRefreshDate = GETDATE() WHERE cInsuLicense = %s AND dTrainBeginDate = %s AND dTrainEndDate = %s"
+    with get_metrics().timer('update'):
+        cursor.execute(stmt, (total, item['salesregid'], item['dTrainBeginDate'], item['dTrainEndDate']))
+    task_log.info("已更新匯總紀錄: %s 課程年月: %s，新總數: %s", item['salesregid'], item['cClassYM'], total)
+
+# --- 批次寫入 (Bulk Write Path) ---
+class BatchWriter:
+    """
+    累積多個任務的明細資料，批次載入暫存表後以集合式 DELETE/INSERT/UPDATE 一次套用，
+    將資料庫往返次數從 O(明細筆數) 降為 O(批次數)。
+    """
+
+    def __init__(self, max_tasks: int = WRITE_BATCH_TASKS, max_rows: int = WRITE_BATCH_ROWS):
+        self._max_tasks = max_tasks
+        self._max_rows = max_rows
+        self._lock = threading.Lock()
+        self._tasks: List[tuple] = []
+        self._details: List[tuple] = []
+        self._callbacks: List[Callable[[], None]] = []
+        self._items: List[Dict] = []
+        self._counters = {'batches': 0, 'tasks': 0, 'rows': 0, 'round_trips': 0, 'failed_batches': 0, 'failed_tasks': 0}
+
+    def submit(self, item: Dict, rows: List[Dict], total: int, after_commit: Optional[Callable[[], None]] = None):
+        """
+        加入一個任務的寫入內容，達到批次上限時由呼叫的執行緒寫入
+        :param item: 任務資料
+        :param rows: API 回傳的明細
+        :param total: API 回傳的總數
+        :param after_commit: 該任務所在批次提交後呼叫
+        """
+        with self._lock:
+            if after_commit is not None:
+                self._callbacks.append(after_commit)
+            self._items.append(item)
+            self._tasks.append((item['salesregid'], item['dTrainBeginDate'], item['dTrainEndDate'], item['cClassYM'], total))
+            self._details.extend(
+                (item['cClassYM'], item['salesregid'], row['fullname'], row['finish_time'])
+                for row in rows
+            )
+            full = len(self._tasks) >= self._max_tasks or len(self._details) >= self._max_rows
+            batch = self._take_locked() if full else None
+        task_log.info("已加入批次寫入佇列: %s 課程年月: %s，明細 %d 條", item['salesregid'], item['cClassYM'], len(rows))
+        if batch:
+            self._flush_batch(*batch)
+
+    def flush(self):
+        """寫入目前累積的所有內容"""
+        with self._lock:
+            batch = self._take_locked()
+        if batch[0]:
+            self._flush_batch(*batch)
+
+    def _take_locked(self):
+        batch = (self._tasks, self._details, self._callbacks, self._items)
+        self._tasks, self._details, self._callbacks, self._items = [], [], [], []
+        return batch
+
+    def _execute(self, cursor, stmt: str, params=None):
+        cursor.execute(stmt, params)
+        with self._lock:
+            self._counters['round_trips'] += 1
+
+    def _bulk_insert(self, cursor, table: str, columns: str, rows: List[tuple]):
+        """以多列 VALUES 一次載入多筆資料到暫存表"""
+        for start in range(0, len(rows), BULK_INSERT_ROWS_PER_STATEMENT):
+            chunk = rows[start:start + BULK_INSERT_ROWS_PER_STATEMENT]
+            placeholders = ', '.join('(' + ', '.join(['%s'] * len(chunk[0])) + ')' for _ in chunk)
+            params = tuple(value for row in chunk for value in row)
+            self._execute(cursor, f"INSERT INTO {table} ({columns}) VALUES {placeholders}", params)
+
+    def _flush_batch(self, tasks: List[tuple], details: List[tuple], callbacks: List[Callable[[], None]], items: List[Dict]):
+        """
+        在單一交易中將一個批次套用到正式表；遇到死結或連線中斷時重試，
+        仍失敗時將批次中的任務記錄為失敗 (這些任務在加入批次時已回報成功)
+        """
+        metrics = get_metrics()
+        for attempt in range(1, WRITE_BATCH_ATTEMPTS + 1):
+            try:
+                with metrics.timer('batch_write'), get_db_pool().connection() as conn, db_transaction(conn) as cursor:
+                    self._apply(cursor, tasks, details)
+                break
+            except Exception as e:
+                kind = classify_failure(e)
+                if kind in ('deadlock', 'connection') and attempt < WRITE_BATCH_ATTEMPTS:
+                    delay = RETRY_BASE_DELAY * random.uniform(0.5, 1.5)
+                    logging.warning(f"批次寫入暫時性失敗 ({kind})，{delay:.1f} 秒後重試 ({len(tasks)} 個任務): {e}")
+                    metrics.inc('batch_retries')
+                    time.sleep(delay)
+                    continue
+                logging.error(f"批次寫入失敗 ({len(tasks)} 個任務): {e}")
+                with self._lock:
+                    self._counters['failed_batches'] += 1
+                    self._counters['failed_tasks'] += len(tasks)
+                get_retry_policy().record_batch_failure(len(items))
+                for item in items:
+                    _record_checkpoint(item, False)
+                return
+        with self._lock:
+            self._counters['batches'] += 1
+            self._counters['tasks'] += len(tasks)
+            self._counters['rows'] += len(details)
+        metrics.inc('rows_written', len(details))
+        logging.info(f"已批次寫入 {len(tasks)} 個任務，共 {len(details)} 條明細")
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logging.error(f"批次提交後的處理失敗: {e}")
+
+    def _apply(self, cursor, tasks: List[tuple], details: List[tuple]):
+        self._execute(cursor, """
+            IF OBJECT_ID('tempdb..#SyncTask') IS NOT NULL DROP TABLE #SyncTask;
+            IF OBJECT_ID('tempdb..#SyncDetail') IS NOT NULL DROP TABLE #SyncDetail;
+            -- 暫存表預設使用 tempdb 的定序，改用目前資料庫的定序以免與正式表 JOIN 時定序衝突
+            CREATE TABLE #SyncTask (
+                cInsuLicense NVARCHAR(50) COLLATE DATABASE_DEFAULT, dTrainBeginDate DATETIME, dTrainEndDate DATETIME,
+                cClassYM NVARCHAR(10) COLLATE DATABASE_DEFAULT, nTotalComplete INT
+            );
+            CREATE TABLE #SyncDetail (
+                cClassYM NVARCHAR(10) COLLATE DATABASE_DEFAULT, cInsuLicense NVARCHAR(50) COLLATE DATABASE_DEFAULT,
+                cCourse NVARCHAR(500) COLLATE DATABASE_DEFAULT, dChgDate DATETIME
+            );
+        """)
+        self._bulk_insert(cursor, '#SyncTask', 'cInsuLicense, dTrainBeginDate, dTrainEndDate, cClassYM, nTotalComplete', tasks)
+        if details:
+            self._bulk_insert(cursor, '#SyncDetail', 'cClassYM, cInsuLicense, cCourse, dChgDate', details)
+        self._execute(cursor, """
+            DELETE Y
+            FROM NYDB.AT.InsuExternalTrainingY Y
+            JOIN #SyncTask T
+              ON  Y.cInsuLicense = T.cInsuLicense
+              AND Y.dChgDate >= T.dTrainBeginDate
+              AND Y.dChgDate <= T.dTrainEndDate;
+
+            INSERT INTO NYDB.AT.InsuExternalTrainingY (
+                cClassYM, cInsuLicense, cEmpIdn, cCourse, dChgDate
+            )
+            SELECT D.cClassYM, D.cInsuLicense, E.cEmpIdn, D.cCourse, D.dChgDate
+            FROM #SyncDetail D
+            JOIN (
+                SELECT L.cInsuLicense, NYDB.AT.getEmpIdnByInsuLicence(L.cInsuLicense) AS cEmpIdn
+                FROM (SELECT DISTINCT cInsuLicense FROM #SyncTask) L
+            ) E ON E.cInsuLicense = D.cInsuLicense;
+
+            UPDATE X
+            SET nTotalComplete = T.nTotalComplete, dRefreshDate = GETDATE()
+            FROM NYDB.AT.InsuExternalTrainingX X
+            JOIN #SyncTask T
+              ON  X.cInsuLicense = T.cInsuLicense
+              AND X.dTrainBeginDate = T.dTrainBeginDate
+              AND X.dTrainEndDate = T.dTrainEndDate;
+
+            DROP TABLE #SyncTask;
+            DROP TABLE #SyncDetail;
+        """)
+
+    def stats(self) -> Dict[str, int]:
+        """回傳批次寫入統計資料"""
+        with self._lock:
+            return dict(self._counters)
+
+_batch_writer: Optional[BatchWriter] = None
+_write_mode = 'row'
+_incremental = False
+_fingerprint_cache = False
+_count_probe = False
+_api_page_fields = (API_LIMIT_FIELD, API_OFFSET_FIELD)
+_paging_supported: Optional[bool] = None  # 伺服器是否套用分頁參數，None 表示尚未確認
+_fetch_strategy = 'auto'
+
+TASKS_QUERY = """
+    SELECT
+        A.cInsuLicense as salesregid,
+        DATEDIFF(second, '1970-01-01', DATEADD(hour, -8, dTrainBeginDate)) as finish_start_date,
+        DATEDIFF(second, '1970-01-01', DATEADD(hour, -8, DATEADD(day, 1, dTrainEndDate)))-1 as finish_end_date,
+        CONVERT(VARCHAR(10), dTrainBeginDate, 120) AS dTrainBeginDate,
+        CONVERT(VARCHAR(10), dTrainEndDate, 120) AS dTrainEndDate,
+        nTotalComplete,
+        cClassYM,
+        cRegNumber
+    FROM NYDB.AT.InsuExternalTrainingX A
+    JOIN NYDB.AT.vInsuSalesEmpX B
+      ON  B.cEmpIdn = A.cEmpIdn
+      AND B.cWorkingStatus = 'W'
+    WHERE A.cRegNumber IS NOT NULL
+    AND   A.nTotalComplete <> nShouldComplete
+"""
+
+# 任務優先順序 (--priority) 可用的排序鍵
+PRIORITY_ORDER_BY = {
+    # 尚未到期且最接近期限者優先，已過期者排在最後
+    'deadline': "CASE WHEN A.dTrainEndDate >= CAST(GETDATE() AS DATE) THEN 0 ELSE 1 END, A.dTrainEndDate",
+    # 應完成與已完成差距大者優先
+    'gap': "nShouldComplete - A.nTotalComplete DESC",
+    # 最久未同步者優先 (從未同步的 NULL 排在最前)
+    'age': "A.dRefreshDate"
+}
+
+def build_tasks_query(priority: Sequence[str] = ()) -> str:
+    """
+    依優先順序鍵組成任務查詢，未指定時維持資料庫回傳的順序
+    :param priority: PRIORITY_ORDER_BY 的鍵，越前面越優先
+    """
+    if not priority:
+        return TASKS_QUERY
+    return TASKS_QUERY + "    ORDER BY " + ", ".join(PRIORITY_ORDER_BY[key] for key in priority) + "\n"
+
+def iter_task_chunks(chunk_size: int = FETCH_CHUNK_SIZE, priority: Sequence[str] = ()) -> Iterator[List[Dict]]:
+    """
+    以 fetchmany 分段讀取待處理任務，第一段讀到即可開始處理
+    :param chunk_size: 每段筆數
+    :param priority: 任務優先順序鍵
+    :return: 任務清單的產生器
+    """
+    try:
+        with get_db_pool().connection() as conn:
+            with conn.cursor(as_dict=True) as cursor:
+                metrics = get_metrics()
+                with metrics.timer('fetch_tasks'):
+                    cursor.execute(build_tasks_query(priority))
+                while True:
+                    with metrics.timer('fetch_tasks'):
+                        chunk = cursor.fetchmany(chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+    except Exception as e:
+        logging.error(f"獲取任務失敗: {e}")
+
+def iter_tasks(chunk_size: int = FETCH_CHUNK_SIZE, priority: Sequence[str] = ()) -> Iterator[Dict]:
+    """逐筆產生待處理任務"""
+    for chunk in iter_task_chunks(chunk_size, priority):
+        yield from chunk
+
+def limit_dispatch(tasks: Iterator[Dict], deadline: Optional[float] = None,
+                   stop: Optional[threading.Event] = None) -> Iterator[Dict]:
+    """
+    超過時間預算或收到停止訊號後停止派發新任務，已派發的任務照常完成；
+    任務已依優先順序排列，因此中途停止時最重要的任務已先處理
+    :param tasks: 任務產生器
+    :param deadline: time.monotonic() 基準的截止時間
+    :param stop: 設定後停止派發的旗標
+    """
+    try:
+        for item in tasks:
+            if deadline is not None and time.monotonic() >= deadline:
+                logging.warning("已用完時間預算，停止派發新任務。")
+                return
+            if stop is not None and stop.is_set():
+                logging.warning("收到停止訊號，停止派發新任務。")
+                return
+            yield item
+    finally:
+        close = getattr(tasks, 'close', None)
+        if close is not None:
+            close()
+
+def fetch_tasks() -> List[Dict]:
+    """从数据库获取待处理任务"""
+    return list(iter_tasks())
+
+def _retry_or_give_up(item: Dict, attempt: int, error: TransientSyncError):
+    """
+    暫時性失敗時依重試策略決定是否重試
+    :raises RetryLater: 尚未達到嘗試上限
+    """
+    delay = get_retry_policy().next_delay(attempt, error.kind)
+    if delay is not None:
+        logging.warning(f"暫時性錯誤，{delay:.1f} 秒後重試 (第 {attempt + 1} 次): {item['salesregid']} - {error}")
+        raise RetryLater(delay) from error
+    logging.error(f"嘗試 {attempt} 次後仍失敗: {item['salesregid']} - {error}")
+
+def _finish_task(item: Dict, attempt: int, ok: bool) -> bool:
+    """記錄任務最終結果"""
+    get_retry_policy().record_result(attempt, ok)
+    if not ok:
+        _record_checkpoint(item, False)
+    return ok
+
+def process_single_task(item: Dict, session: SessionManager, attempt: int = 1) -> bool:
+    """
+    处理单个任务；session 失效時重新登入並重試
+    :param attempt: 第幾次嘗試 (暫時性失敗重新放回佇列時遞增)
+    :raises RetryLater: 暫時性失敗且尚未達到嘗試上限
+    """
+    ok = False
+    try:
+        for _ in range(SESSION_REPLAY_LIMIT + 1):
+            cookie_str, generation = session.current()
+            try:
+                ok = sync_data(item, cookie_str)
+                break
+            except SessionExpiredError as e:
+                logging.warning(f"Session 失效: {item['salesregid']} - {e}")
+                if not session.refresh(generation):
+                    break
+                logging.info(f"以新的 session 重試任務: {item['salesregid']}")
+    except TransientSyncError as e:
+        _retry_or_give_up(item, attempt, e)
+    except Exception as e:
+        logging.error(f"任務處理異常: {item['salesregid']} - {e}")
+    return _finish_task(item, attempt, ok)
+
+def run_task_queue(tasks: Iterable[Dict], handler: Callable[[Dict, int], bool],
+                   workers: int = MAX_WORKERS, queue_size: int = TASK_QUEUE_SIZE) -> Tuple[int, int]:
+    """
+    以有上限的工作佇列處理任務：呼叫端執行緒邊讀取邊放入佇列，工作執行緒邊取出邊處理，
+    佇列滿時讀取端會暫停，記憶體用量與待處理任務總數無關。
+    handler 拋出 RetryLater 時，任務在等待指定秒數後重新放回同一個佇列。
+    :param tasks: 任務產生器
+    :param handler: 處理單一任務的函式 (任務, 第幾次嘗試)，回傳是否成功
+    :param workers: 工作執行緒數
+    :param queue_size: 佇列上限
+    :return: (成功數, 總數)
+    """
+    work: queue.Queue = queue.Queue(maxsize=queue_size)
+    done = threading.Condition()
+    counts = [0, 0]
+    outstanding = [0]  # 已放入佇列 (含等待重試) 但尚未有最終結果的任務數
+
+    def worker():
+        while True:
+            entry = work.get()
+            if entry is None:
+                return
+            item, attempt = entry
+            try:
+                ok = handler(item, attempt)
+            except RetryLater as e:
+                timer = threading.Timer(e.delay, work.put, args=((item, attempt + 1),))
+                timer.daemon = True
+                timer.start()
+                continue
+            except Exception as e:
+                # 例如記錄結果時寫入續傳紀錄檔失敗；仍需計入結果，否則呼叫端會一直等待
+                logging.error(f"任務處理異常: {item['salesregid']} - {type(e).__name__}: {e}")
+                ok = False
+            with done:
+                counts[0] += bool(ok)
+                counts[1] += 1
+                outstanding[0] -= 1
+                done.notify_all()
+
+    threads = [threading.Thread(target=worker, name=f'sync-worker-{i}', daemon=True) for i in range(workers)]
+    for thread in threads:
+        thread.start()
+    try:
+        for item in tasks:
+            with done:
+                outstanding[0] += 1
+            work.put((item, 1))
+        with done:
+            done.wait_for(lambda: outstanding[0] == 0)
+    finally:
+        for _ in threads:
+            work.put(None)
+        for thread in threads:
+            thread.join()
+    return counts[0], counts[1]
+
+def _fetch_stage(item: Dict, session: SessionManager, attempt: int = 1) -> Optional[Tuple[Callable[[Dict], bool], Dict]]:
+    """
+    管線的抓取階段：送出 API 請求並解析回應；session 失效時重新登入並重試
+    :return: (處理 API 回應的函式, API 回應)；失敗時回傳 None
+    :raises RetryLater: 暫時性失敗且尚未達到嘗試上限
+    """
+    try:
+        for _ in range(SESSION_REPLAY_LIMIT + 1):
+            cookie_str, generation = session.current()
+            try:
+                return fetch_api_data(item, cookie_str)
+            except SessionExpiredError as e:
+                logging.warning(f"Session 失效: {item['salesregid']} - {e}")
+                if not session.refresh(generation):
+                    break
+                logging.info(f"以新的 session 重試任務: {item['salesregid']}")
+    except requests.exceptions.RequestException as e:
+        kind = classify_failure(e)
+        if kind in TRANSIENT_FAILURES:
+            _retry_or_give_up(item, attempt, TransientSyncError(kind, e))
+        else:
+            logging.error(f"API請求失敗: {item['salesregid']} - {e}")
+    except Exception as e:
+        logging.error(f"任務處理異常: {item['salesregid']} - {e}")
+    return None
+
+def _write_stage(item: Dict, fetched: Tuple[Callable[[Dict], bool], Dict], attempt: int = 1) -> bool:
+    """
+    管線的寫入階段：將抓取階段的結果寫入資料庫
+    :raises RetryLater: 資料庫暫時性失敗 (死結、連線中斷) 且尚未達到嘗試上限
+    """
+    handle, api_data = fetched
+    try:
+        return handle(api_data)
+    except pymssql.Error as e:
+        kind = classify_failure(e)
+        if kind in TRANSIENT_FAILURES:
+            _retry_or_give_up(item, attempt, TransientSyncError(kind, e))
+        else:
+            logging.error(f"資料庫操作失敗: {item['salesregid']} - {e}")
+    except Exception as e:
+        logging.error(f"未知錯誤: {item['salesregid']} - {e}")
+    return False
+
+def run_pipeline(tasks: Iterable[Dict], fetch: Callable[[Dict, int], Optional[Any]], write: Callable[[Dict, Any, int], bool],
+                 fetch_workers: int = MAX_WORKERS, write_workers: int = PIPELINE_WRITE_WORKERS,
+                 queue_size: int = PIPELINE_QUEUE_SIZE) -> Tuple[int, int, Dict[str, Any]]:
+    """
+    兩段式管線：抓取執行緒呼叫 API，結果經由有上限的佇列交給寫入執行緒寫入資料庫。
+    資料庫變慢時佇列填滿，抓取端隨之暫停 (backpressure)；兩段的執行緒數可分別調整。
+    任一段拋出 RetryLater 時，該段的工作在等待後重新放回該段的佇列。
+    :param tasks: 任務產生器
+    :param fetch: 抓取函式 (任務, 第幾次嘗試)，回傳交給寫入段的結果，失敗時回傳 None
+    :param write: 寫入函式 (任務, 抓取結果, 第幾次嘗試)，回傳是否成功
+    :param fetch_workers: 抓取執行緒數
+    :param write_workers: 寫入執行緒數
+    :param queue_size: 兩段之間的佇列上限
+    :return: (成功數, 總數, 各段使用率統計)
+    """
+    fetch_queue: queue.Queue = queue.Queue(maxsize=fetch_workers * 4)
+    write_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+    done = threading.Condition()
+    counts = [0, 0]
+    outstanding = [0]
+    busy = {'fetch': 0.0, 'write': 0.0, 'blocked': 0.0}
+    peak = [0]
+
+    def finish(ok: bool):
+        with done:
+            counts[0] += bool(ok)
+            counts[1] += 1
+            outstanding[0] -= 1
+            done.notify_all()
+
+    def retry_later(target: queue.Queue, delay: float, entry: tuple):
+        timer = threading.Timer(delay, target.put, args=(entry,))
+        timer.daemon = True
+        timer.start()
+
+    def fetcher():
+        while True:
+            entry = fetch_queue.get()
+            if entry is None:
+                return
+            item, attempt = entry
+            started = time.monotonic()
+            try:
+                result = fetch(item, attempt)
+            except RetryLater as e:
+                retry_later(fetch_queue, e.delay, (item, attempt + 1))
+                continue
+            except Exception as e:
+                logging.error(f"抓取階段異常: {item['salesregid']} - {type(e).__name__}: {e}")
+                result = None
+            finally:
+                elapsed = time.monotonic() - started
+                with done:
+                    busy['fetch'] += elapsed
+            if result is None:
+                finish(False)
+                continue
+            started = time.monotonic()
+            write_queue.put((item, result, attempt, 1))
+            with done:
+                busy['blocked'] += time.monotonic() - started
+                peak[0] = max(peak[0], write_queue.qsize())
+
+    def writer():
+        while True:
+            entry = write_queue.get()
+            if entry is None:
+                return
+            item, result, fetch_attempts, attempt = entry
+            started = time.monotonic()
+            try:
+                ok = write(item, result, fetch_attempts + attempt - 1)
+            except RetryLater as e:
+                retry_later(write_queue, e.delay, (item, result, fetch_attempts, attempt + 1))
+                continue
+            except Exception as e:
+                logging.error(f"寫入階段異常: {item['salesregid']} - {type(e).__name__}: {e}")
+                ok = False
+            finally:
+                elapsed = time.monotonic() - started
+                with done:
+                    busy['write'] += elapsed
+            finish(ok)
+
+    threads = (
+        [threading.Thread(target=fetcher, name=f'sync-fetch-{i}', daemon=True) for i in range(fetch_workers)]
+        + [threading.Thread(target=writer, name=f'sync-write-{i}', daemon=True) for i in range(write_workers)]
+    )
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    try:
+        for item in tasks:
+            with done:
+                outstanding[0] += 1
+            fetch_queue.put((item, 1))
+        with done:
+            done.wait_for(lambda: outstanding[0] == 0)
+    finally:
+        for _ in range(fetch_workers):
+            fetch_queue.put(None)
+        for _ in range(write_workers):
+            write_queue.put(None)
+        for thread in threads:
+            thread.join()
+    elapsed = max(time.monotonic() - started, 1e-9)
+    utilisation = {
+        'fetch_workers': fetch_workers,
+        'write_workers': write_workers,
+        'fetch_utilisation': round(busy['fetch'] / (fetch_workers * elapsed), 3),
+        'write_utilisation': round(busy['write'] / (write_workers * elapsed), 3),
+        'fetch_blocked_seconds': round(busy['blocked'], 3),  # 抓取端因寫入佇列已滿而等待的時間
+        'write_queue_peak': peak[0]
+    }
+    return counts[0], counts[1], utilisation
+
+# --- 非同步執行模式 (Asyncio Execution Mode) ---
+class AsyncApiClient:
+    """
+    非同步 API 用戶端。
+    已安裝 aiohttp 時以單一執行緒的事件迴圈送出請求；否則退回在執行緒中使用共用的 HTTP Session。
+    錯誤一律轉換為 requests.exceptions.RequestException，讓同步與非同步模式共用錯誤處理。
+    """
+
+    def __init__(self, concurrency: int):
+        self._concurrency = concurrency
+        self._session = None
+        self._executor = None
+
+    async def __aenter__(self):
+        try:
+            import aiohttp
+        except ImportError:
+            logging.warning("未安裝 aiohttp，非同步模式改以執行緒送出 HTTP 請求。")
+            self._executor = ThreadPoolExecutor(max_workers=self._concurrency)
+            return self
+        connector = aiohttp.TCPConnector(limit=self._concurrency, limit_per_host=self._concurrency, keepalive_timeout=30)
+        self._session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT),
+            headers={'User-Agent': USER_AGENT}
+        )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        if self._session is not None:
+            await self._session.close()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+    async def post_json(self, url: str, headers: Dict[str, str], data: Dict[str, Any]) -> Dict:
+        """送出 POST 請求並回傳 JSON 內容"""
+        if self._session is None:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, self._post_json_blocking, url, headers, data)
+
+        import aiohttp
+        try:
+            async with self._session.post(url, headers=headers, data=data, allow_redirects=False) as response:
+                if response.status in (401, 403) or 300 <= response.status < 400:
+                    raise SessionExpiredError(f"HTTP {response.status}")
+                response.raise_for_status()
+                text = await response.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise requests.exceptions.RequestException(str(e) or type(e).__name__) from e
+        try:
+            with get_metrics().timer('json_decode'):
+                return json.loads(text)
+        except ValueError:
+            raise SessionExpiredError("API 回應不是 JSON (可能為登入頁面)")
+
+    @staticmethod
+    def _post_json_blocking(url: str, headers: Dict[str, str], data: Dict[str, Any]) -> Dict:
+        response = get_http_session().post(url, headers=headers, data=data, timeout=REQUEST_TIMEOUT, allow_redirects=False)
+        return _parse_api_response(response)
+
+async def _async_post_api(client: AsyncApiClient, item: Dict, cookie_str: str, payload: Optional[Dict[str, Any]] = None) -> Dict:
+    """經由速率控制器送出非同步 API 請求，並回報回應時間與狀態"""
+    limiter = get_rate_limiter()
+    metrics = get_metrics()
+    with metrics.timer('sleep'):
+        await limiter.acquire_async()
+    started = time.monotonic()
+    try:
+        api_data = await client.post_json(API_URL, _api_headers(cookie_str), payload or _api_payload(item))
+    except requests.exceptions.RequestException as e:
+        metrics.observe('http_request', time.monotonic() - started)
+        limiter.record(time.monotonic() - started, _api_error_status(e), failed=True)
+        raise
+    metrics.observe('http_request', time.monotonic() - started)
+    limiter.record(time.monotonic() - started, 200)
+    return api_data
+
+async def _async_fetch_part(client: AsyncApiClient, item: Dict, cookie_str: str, payload: Dict[str, Any]) -> Dict:
+    api_data = await _async_post_api(client, item, cookie_str, payload)
+    _check_api_data(api_data)
+    return api_data
+
+async def _async_fetch_full(client: AsyncApiClient, item: Dict, cookie_str: str, payload: Dict[str, Any], expected: int) -> Dict:
+    """_fetch_full 的非同步版本，各分段以 asyncio.gather 同時查詢"""
+    strategy, parts = _plan_fetch(item, payload, expected)
+    responses: List[Dict] = []
+    api_data = None
+    while parts:
+        responses.extend(await asyncio.gather(*(_async_fetch_part(client, item, cookie_str, part) for part in parts)))
+        api_data, parts = _merge_parts(strategy, payload, responses)
+    if strategy != 'single':
+        _record_split_fetch(item, strategy, len(responses), api_data is None)
+    if api_data is None:
+        api_data = await _async_fetch_part(client, item, cookie_str, payload)
+    return api_data
+
+async def async_sync_data(item: Dict, cookie_str: str, client: AsyncApiClient, db_executor: ThreadPoolExecutor) -> bool:
+    """
+    sync_data 的非同步版本：HTTP 請求在事件迴圈中等待，資料庫寫入交給 db_executor 執行
+    :param item: 包含銷售登記ID和日期範圍的資料字典
+    :param cookie_str: 用於驗證的 Cookie
+    :param client: 非同步 API 用戶端
+    :param db_executor: 執行資料庫寫入的執行緒池
+    :return: 是否同步成功
+    :raises SessionExpiredError: session 已失效，需重新登入後重試
+    :raises TransientSyncError: 暫時性失敗，可稍後重試
+    """
+    try:
+        payload, handle = _prepare_request(item)
+        api_data = None
+        expected = item['nTotalComplete']
+        if _use_count_probe():
+            api_data = await _async_post_api(client, item, cookie_str, _probe_payload(item))
+            if not _accept_probe(item, api_data):
+                expected, api_data = api_data['total'], None
+        if api_data is None:
+            api_data = await _async_fetch_full(client, item, cookie_str, payload, expected)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(db_executor, handle, api_data)
+
+    except SessionExpiredError:
+        raise
+    except requests.exceptions.RequestException as e:
+        _raise_if_transient(e)
+        logging.error(f"API請求失敗: {item['salesregid']} - {e}")
+    except pymssql.Error as e:
+        _raise_if_transient(e)
+        logging.error(f"資料庫操作失敗: {item['salesregid']} - {e}")
+    except Exception as e:
+        logging.error(f"未知錯誤: {item['salesregid']} - {e}")
+
+    return False
+
+async def _async_process_single_task(item: Dict, session: SessionManager, client: AsyncApiClient,
+                                     db_executor: ThreadPoolExecutor, attempt: int = 1) -> bool:
+    """
+    處理單個任務 (非同步)；session 失效時在執行緒中重新登入並重試
+    :param attempt: 第幾次嘗試
+    :raises RetryLater: 暫時性失敗且尚未達到嘗試上限
+    """
+    ok = False
+    try:
+        for _ in range(SESSION_REPLAY_LIMIT + 1):
+            cookie_str, generation = await session.current_async()
+            try:
+                ok = await async_sync_data(item, cookie_str, client, db_executor)
+                break
+            except SessionExpiredError as e:
+                logging.warning(f"Session 失效: {item['salesregid']} - {e}")
+                # Playwright 同步 API 不能在事件迴圈中執行，交給獨立執行緒
+                if not await asyncio.get_running_loop().run_in_executor(None, session.refresh, generation):
+                    break
+                logging.info(f"以新的 session 重試任務: {item['salesregid']}")
+    except TransientSyncError as e:
+        _retry_or_give_up(item, attempt, e)
+    except Exception as e:
+        logging.error(f"任務處理異常: {item['salesregid']} - {e}")
+    return _finish_task(item, attempt, ok)
+
+async def async_run_tasks(tasks: Iterable[Dict], session: SessionManager, concurrency: int = ASYNC_CONCURRENCY) -> Tuple[int, int]:
+    """
+    以單一事件迴圈同步所有任務；任務在執行緒中分段讀取，同時進行中的任務數不超過 concurrency
+    :param tasks: 任務產生器
+    :param session: 共用的登入狀態
+    :param concurrency: 同時進行中的任務上限
+    :return: (成功數, 總數)
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    counts = [0, 0]
+    running = set()
+    iterator = iter(tasks)
+    loop = asyncio.get_running_loop()
+
+    async def run_one(item: Dict):
+        held = True
+        try:
+            attempt = 1
+            while True:
+                try:
+                    ok = await _async_process_single_task(item, session, client, db_executor, attempt)
+                    break
+                except RetryLater as e:
+                    # 等待重試期間讓出名額給其他任務
+                    semaphore.release()
+                    held = False
+                    await asyncio.sleep(e.delay)
+                    await semaphore.acquire()
+                    held = True
+                    attempt += 1
+            counts[0] += bool(ok)
+            counts[1] += 1
+        finally:
+            if held:
+                semaphore.release()
+
+    # 資料庫寫入仍是阻塞呼叫，交給執行緒池；任務游標會一直佔用一條連線，其餘連線分給寫入執行緒
+    db_workers = max(1, get_db_pool().max_size - 1)
+    with ThreadPoolExecutor(max_workers=db_workers) as db_executor:
+        async with AsyncApiClient(concurrency) as client:
+            while True:
+                # 讀取任務會阻塞在資料庫游標上，交給執行緒處理
+                batch = await loop.run_in_executor(db_executor, list, itertools.islice(iterator, FETCH_CHUNK_SIZE))
+                if not batch:
+                    break
+                for item in batch:
+                    await semaphore.acquire()
+                    task = asyncio.create_task(run_one(item))
+                    running.add(task)
+                    task.add_done_callback(running.discard)
+            if running:
+                await asyncio.gather(*running)
+    return counts[0], counts[1]
+
+# --- 常駐排程 (Daemon Scheduler) ---
+class CronSchedule:
+    """
+    精簡的 5 欄位 cron 運算式 (分 時 日 月 星期)，支援 *、數值、範圍 a-b、步進 /n 與逗號清單，
+    以 LOCAL_TZ 計算下次執行時間。日與星期都有限制時，符合其一即可 (與 cron 相同)。
+    """
+    _FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expression: str):
+        parts = expression.split()
+        if len(parts) != 5:
+            raise ValueError(f"cron 運算式需為 5 個欄位: {expression!r}")
+        self.expression = expression
+        self._minutes, self._hours, self._days, self._months, weekdays = (
+            self._parse(part, lo, hi) for part, (lo, hi) in zip(parts, self._FIELDS)
+        )
+        self._weekdays = {day % 7 for day in weekdays}  # 0 與 7 都代表星期日
+        self._any_day = parts[2] == '*'
+        self._any_weekday = parts[4] == '*'
+
+    @staticmethod
+    def _parse(field: str, lo: int, hi: int) -> set:
+        values = set()
+        for part in field.split(','):
+            body, _, step = part.partition('/')
+            step = int(step) if step else 1
+            if body == '*':
+                start, end = lo, hi
+            elif '-' in body:
+                start, end = (int(value) for value in body.split('-', 1))
+            else:
+                start = int(body)
+                end = hi if step > 1 else start
+            if step < 1 or not lo <= start <= end <= hi:
+                raise ValueError(f"cron 欄位超出範圍 {lo}-{hi}: {part!r}")
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _day_matches(self, moment: datetime) -> bool:
+        day = moment.day in self._days
+        weekday = moment.isoweekday() % 7 in self._weekdays
+        if self._any_day or self._any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def next_after(self, moment: datetime) -> datetime:
+        """回傳 moment 之後 (不含) 第一個符合的時間點"""
+        moment = moment.astimezone(LOCAL_TZ).replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = moment + timedelta(days=366 * 5)
+        while moment < limit:
+            if moment.month not in self._months:
+                moment = (moment.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(moment):
+                moment = moment.replace(hour=0, minute=0) + timedelta(days=1)
+            elif moment.hour not in self._hours:
+                moment = moment.replace(minute=0) + timedelta(hours=1)
+            elif moment.minute not in self._minutes:
+                moment += timedelta(minutes=1)
+            else:
+                return moment
+        raise ValueError(f"cron 運算式沒有可執行的時間: {self.expression!r}")
+
+def install_shutdown_handlers() -> threading.Event:
+    """
+    收到 SIGINT/SIGTERM 時設定停止旗標：不再派發新任務，等待進行中的任務完成後結束；
+    再收到一次 SIGINT 則立即中止
+    """
+    stop = threading.Event()
+
+    def handle(signum, frame):
+        if stop.is_set() and signum == signal.SIGINT:
+            raise KeyboardInterrupt
+        logging.warning(f"收到 {signal.Signals(signum).name}，完成進行中的任務後結束 (再按一次 Ctrl+C 立即中止)。")
+        stop.set()
+
+    signal.signal(signal.SIGINT, handle)
+    signal.signal(signal.SIGTERM, handle)
+    return stop
+
+def run_daemon(args: argparse.Namespace):
+    """常駐模式：依 --interval 或 --cron 反覆執行同步，HTTP Session、資料庫連線池、瀏覽器與 OCR 模型在各次之間保持常駐"""
+    stop = install_shutdown_handlers()
+    schedule = args.cron
+    logging.info(f"常駐模式啟動 (排程: {schedule.expression if schedule else f'每 {args.interval:g} 秒'})")
+    while not stop.is_set():
+        started = time.time()
+        try:
+            run_sync(args, stop)
+        except Exception as e:
+            logging.error(f"本次同步失敗: {e}")
+        finally:
+            write_run_metrics(args)
+        if stop.is_set():
+            break
+        if schedule is not None:
+            next_run = schedule.next_after(datetime.now(LOCAL_TZ)).timestamp()
+        else:
+            next_run = started + args.interval
+        logging.info(f"下次執行時間: {datetime.fromtimestamp(next_run, LOCAL_TZ):%Y-%m-%d %H:%M:%S}")
+        stop.wait(max(0.0, next_run - time.time()))
+    logging.info("常駐模式已結束。")
+
+# --- 主執行程序 (Main Execution) ---
+def _priority_keys(value: str) -> Tuple[str, ...]:
+    """解析 --priority，例如 "deadline,gap,age" """
+    keys = tuple(key.strip() for key in value.split(',') if key.strip())
+    unknown = [key for key in keys if key not in PRIORITY_ORDER_BY]
+    if unknown:
+        raise argparse.ArgumentTypeError(f"未知的優先順序鍵: {', '.join(unknown)} (可用: {', '.join(PRIORITY_ORDER_BY)})")
+    return keys
+
+def _cron_schedule(value: str) -> CronSchedule:
+    """解析 --cron"""
+    try:
+        return CronSchedule(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+def _parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """解析命令列參數"""
+    parser = argparse.ArgumentParser(description='同步 TII eLearning 完訓資料到 NYDB')
+    parser.add_argument('--mode', choices=('thread', 'async', 'pipeline'), default='thread',
+                        help='執行模式：thread 使用執行緒池，async 使用 asyncio 事件迴圈，'
+                             'pipeline 將 API 抓取與資料庫寫入分為兩組執行緒')
+    parser.add_argument('--workers', type=int, default=MAX_WORKERS,
+                        help='thread 模式的工作執行緒數，HTTP 與資料庫連線池大小隨之調整')
+    parser.add_argument('--fetch-workers', type=int, default=MAX_WORKERS,
+                        help='pipeline 模式的 API 抓取執行緒數')
+    parser.add_argument('--write-workers', type=int, default=PIPELINE_WRITE_WORKERS,
+                        help='pipeline 模式的資料庫寫入執行緒數')
+    parser.add_argument('--write-queue-size', type=int, default=PIPELINE_QUEUE_SIZE,
+                        help='pipeline 模式抓取與寫入之間的佇列上限')
+    parser.add_argument('--concurrency', type=int, default=ASYNC_CONCURRENCY,
+                        help='async 模式下同時進行中的任務上限')
+    parser.add_argument('--write-mode', choices=('row', 'diff', 'bulk'), default='row',
+                        help='資料庫寫入方式：row 逐任務刪除後重寫，diff 只寫入差異明細，'
+                             'bulk 累積多個任務後以集合式語法批次寫入')
+    parser.add_argument('--incremental', action='store_true',
+                        help='增量同步：只查詢並寫入上次同步之後的新完訓紀錄 (僅支援 --write-mode row)')
+    parser.add_argument('--fingerprint', action='store_true',
+                        help='以 API 明細指紋判斷資料是否變化，內容相同時略過所有資料庫寫入')
+    parser.add_argument('--count-probe', action='store_true',
+                        help='先以只取一筆明細的請求查詢數量，與資料庫不同時才下載完整明細 (不適用 --incremental/--fingerprint)')
+    parser.add_argument('--fetch-strategy', choices=('auto', 'single', 'pages', 'windows'), default='auto',
+                        help='明細查詢方式：single 一次查詢；pages 以分頁同時查詢；windows 切分查詢期間同時查詢；'
+                             f'auto 在上次同步的明細數達 {LARGE_FETCH_ROWS} 筆時分頁 (伺服器不支援分頁時切分期間)')
+    parser.add_argument('--api-limit-field', default=API_LIMIT_FIELD,
+                        help='API 分頁參數中筆數上限的欄位名稱')
+    parser.add_argument('--api-offset-field', default=API_OFFSET_FIELD,
+                        help='API 分頁參數中起始位置的欄位名稱')
+    parser.add_argument('--priority', type=_priority_keys, default=(),
+                        help='任務優先順序，以逗號分隔：deadline (期限最近)、gap (差距最大)、age (最久未同步)')
+    parser.add_argument('--time-budget', type=float, default=None,
+                        help='本次執行的時間預算 (秒)，超過後不再派發新任務')
+    parser.add_argument('--checkpoint-file', default=CHECKPOINT_FILE,
+                        help='中斷續傳紀錄檔路徑，空字串表示停用')
+    parser.add_argument('--no-resume', action='store_true',
+                        help='忽略上次中斷的進度紀錄，重新處理所有任務')
+    parser.add_argument('--login-backend', choices=('auto', 'http', 'browser'), default=LOGIN_BACKEND,
+                        help='登入方式：http 不使用瀏覽器，browser 使用 Playwright，auto 先 HTTP 失敗再改用 Playwright')
+    parser.add_argument('--log-verbosity', choices=('full', 'summary'), default='full',
+                        help='full 記錄每個任務的處理細節；summary 只記錄執行摘要、警告與錯誤')
+    parser.add_argument('--log-rotation', choices=('size', 'daily'), default=LOG_ROTATION,
+                        help=f'日誌輪替方式：size 超過 {LOG_MAX_BYTES // (1024 * 1024)}MB 輪替，daily 每日輪替；舊檔以 gzip 壓縮')
+    parser.add_argument('--metrics-json', default=METRICS_JSON_FILE,
+                        help='執行結束時輸出 JSON 統計摘要的路徑，空字串表示不輸出')
+    parser.add_argument('--metrics-prom', default=METRICS_PROM_FILE,
+                        help='執行結束時輸出 Prometheus textfile 的路徑，空字串表示不輸出')
+    parser.add_argument('--max-attempts', type=int, default=RETRY_MAX_ATTEMPTS,
+                        help='逾時、連線中斷、5xx、資料庫死結等暫時性失敗時，單一任務最多嘗試次數')
+    parser.add_argument('--daemon', action='store_true',
+                        help='常駐模式：依 --interval 或 --cron 反覆執行，連線池、session 與 OCR 模型保持常駐')
+    schedule = parser.add_mutually_exclusive_group()
+    schedule.add_argument('--interval', type=float, default=None,
+                          help=f'常駐模式下兩次執行開始時間的間隔 (秒，預設 {DAEMON_INTERVAL})')
+    schedule.add_argument('--cron', type=_cron_schedule, default=None,
+                          help='常駐模式的 cron 排程 (分 時 日 月 星期，UTC+8)，例如 "*/30 8-18 * * 1-5"')
+    parser.add_argument('--initial-rate', type=float, default=RATE_INITIAL,
+                        help='API 初始每秒請求數')
+    parser.add_argument('--max-rate', type=float, default=RATE_MAX,
+                        help='API 每秒請求數上限')
+    args = parser.parse_args(argv)
+    if (args.cron is not None or args.interval is not None) and not args.daemon:
+        parser.error('--interval/--cron 需搭配 --daemon 使用')
+    if args.incremental and args.write_mode != 'row':
+        parser.error('--incremental 只新增新的明細，需搭配 --write-mode row')
+    if args.interval is None:
+        args.interval = DAEMON_INTERVAL
+    return args
+
+def configure_worker_pools(workers: int, db_workers: Optional[int] = None):
+    """
+    依工作執行緒數重新建立 HTTP Session 與資料庫連線池 (每個執行緒一條連線，資料庫另加 fetch_tasks 一條)
+    :param workers: 送出 API 請求的執行緒數
+    :param db_workers: 寫入資料庫的執行緒數，預設與 workers 相同
+    """
+    global _http_session, _db_pool
+    close_http_session()
+    close_db_pool()
+    with _http_session_lock:
+        _http_session = _build_http_session(workers)
+    with _db_pool_lock:
+        _db_pool = DBConnectionPool(max_size=(db_workers or workers) + 1)
+
+def configure_run(args: argparse.Namespace):
+    """依命令列參數設定寫入方式、登入方式、速率控制與連線池 (常駐模式下只設定一次，各次執行共用)"""
+    global _write_mode, _login_backend, _incremental, _fingerprint_cache, _count_probe, _api_page_fields, \
+        _paging_supported, _fetch_strategy
+    _write_mode = args.write_mode
+    _incremental = args.incremental
+    _fingerprint_cache = args.fingerprint
+    _count_probe = args.count_probe
+    _api_page_fields = (args.api_limit_field, args.api_offset_field)
+    _paging_supported = None
+    _fetch_strategy = args.fetch_strategy
+    if _count_probe and (_incremental or _fingerprint_cache):
+        logging.warning("--count-probe 不適用於 --incremental/--fingerprint，將下載完整明細")
+    _login_backend = args.login_backend
+    configure_rate_limiter(args.initial_rate, args.max_rate)
+    if args.mode == 'pipeline':
+        configure_worker_pools(args.fetch_workers, args.write_workers)
+    elif args.workers != MAX_WORKERS:
+        configure_worker_pools(args.workers)
+
+def run_sync(args: argparse.Namespace, stop: Optional[threading.Event] = None):
+    """
+    執行一次完整的同步流程：確認 session、讀取任務、同步資料
+    :param args: 命令列參數 (需先呼叫 configure_run)
+    :param stop: 設定後不再派發新任務，等待進行中的任務完成後返回
+    """
+    global _batch_writer, _checkpoint
+    started = time.monotonic()
+    metrics = reset_metrics()
+    limiter = get_rate_limiter()
+    retry_policy = configure_retry_policy(args.max_attempts)
+
+    # 1. 檢查或獲取 Cookie (派發任務前先確認 session 有效)
+    cookie_str = ensure_session()
+    if not cookie_str:
+        return
+
+    # 2. 獲取待處理資料 (串流讀取，讀到第一筆即開始處理)
+    tasks = iter_tasks(priority=args.priority)
+    first = next(tasks, None)
+    if first is None:
+        logging.info("没有需要處理的資料。")
+        return
+    tasks = itertools.chain([first], tasks)
+    if args.checkpoint_file:
+        _checkpoint = CheckpointJournal(args.checkpoint_file, resume=not args.no_resume)
+        tasks = _checkpoint.resume(tasks)
+    if args.time_budget is not None or stop is not None:
+        deadline = started + args.time_budget if args.time_budget is not None else None
+        tasks = limit_dispatch(tasks, deadline, stop)
+
+    # 3. 同步處理資料
+    logging.info(
+        f"開始處理資料 (模式: {args.mode}，寫入: {args.write_mode}，增量: {args.incremental}，"
+        f"優先順序: {','.join(args.priority) or '無'})"
+    )
+    if args.write_mode == 'bulk':
+        _batch_writer = BatchWriter()
+    session = SessionManager(cookie_str)
+    finished = False
+    try:
+        if args.mode == 'async':
+            success_count, total = asyncio.run(async_run_tasks(tasks, session, args.concurrency))
+        elif args.mode == 'pipeline':
+            def fetch_task(task: Dict, attempt: int):
+                fetched = _fetch_stage(task, session, attempt)
+                if fetched is None:
+                    _finish_task(task, attempt, False)  # 抓取失敗不會進入寫入階段，在此記錄結果
+                return fetched
+
+            success_count, total, utilisation = run_pipeline(
+                tasks,
+                fetch_task,
+                lambda task, fetched, attempt: _finish_task(task, attempt, _write_stage(task, fetched, attempt)),
+                fetch_workers=args.fetch_workers, write_workers=args.write_workers, queue_size=args.write_queue_size
+            )
+            logging.info(f"管線各階段使用率: {utilisation}")
+            for name, value in utilisation.items():
+                metrics.set_gauge(f'pipeline_{name}', value)
+        else:
+            success_count, total = run_task_queue(
+                tasks, lambda task, attempt: process_single_task(task, session, attempt),
+                workers=args.workers, queue_size=args.workers * 4
+            )
+
+        if _batch_writer is not None:
+            _batch_writer.flush()
+            batch_stats = _batch_writer.stats()
+            success_count -= batch_stats['failed_tasks']
+            logging.info(f"批次寫入統計: {batch_stats}")
+        finished = True
+    finally:
+        _batch_writer = None
+        if _checkpoint is not None:
+            # 只有正常結束且任務來源全部讀完 (未因時間預算中止) 才算完成
+            _checkpoint.close(completed=finished and _checkpoint.exhausted)
+            if _checkpoint.resumed:
+                logging.info(f"續傳時略過 {_checkpoint.resumed} 個已完成的任務")
+            _checkpoint = None
+    metrics.inc('tasks_total', total)
+    metrics.inc('tasks_succeeded', success_count)
+    metrics.inc('tasks_failed', total - success_count)
+    metrics.inc('session_refreshes', session.refreshes)
+    retry_stats = retry_policy.stats()
+    for kind, count in retry_stats['retries'].items():
+        metrics.inc(f'retries_{kind}', count)
+    for attempts, count in retry_stats['attempts'].items():
+        metrics.inc(f'tasks_finished_after_{attempts}_attempts', count)
+    metrics.inc('retries_gave_up', retry_stats['gave_up'])
+    metrics.inc('tasks_failed_in_batch', retry_stats['batch_failed'])
+    logging.info(f"處理完成: 成功 {success_count}/{total} 條 (執行中重新登入 {session.refreshes} 次)")
+    logging.info(f"API 速率統計: {limiter.stats()}")
+    logging.info(f"重試統計: {retry_stats}")
+    counters = metrics.snapshot()['counters']
+    if counters.get('count_probes'):
+        logging.info(
+            f"Count probe 統計: 查詢 {counters['count_probes']} 次，略過下載 {counters.get('count_probe_skips', 0)} 次，"
+            f"需下載完整明細 {counters.get('count_probe_misses', 0)} 次，估計節省 {counters.get('count_probe_bytes_saved', 0)} bytes，"
+            f"未命中的 probe 額外下載 {counters.get('count_probe_bytes_wasted', 0)} bytes，"
+            f"淨節省 {counters.get('count_probe_bytes_saved', 0) - counters.get('count_probe_bytes_wasted', 0)} bytes"
+        )
+
+def write_run_metrics(args: argparse.Namespace):
+    """輸出本次執行的統計檔，並在日誌中記錄各階段耗時摘要"""
+    metrics = get_metrics()
+    summary = metrics.snapshot()
+    logging.info(f"執行統計: {json.dumps(summary['counters'], ensure_ascii=False)}")
+    for stage, hist in summary['stages'].items():
+        logging.info(
+            f"階段耗時 {stage}: {hist['count']} 次，合計 {hist['sum_seconds']:.2f}s，"
+            f"p50 {hist['p50_seconds'] * 1000:.0f}ms，p95 {hist['p95_seconds'] * 1000:.0f}ms"
+        )
+    try:
+        metrics.write(args.metrics_json, args.metrics_prom)
+    except OSError as e:
+        logging.error(f"輸出執行統計失敗: {e}")
+
+def main(argv: Optional[List[str]] = None):
+    """主程序"""
+    from dotenv import load_dotenv
+    load_dotenv() # 載入 .env 檔案中的環境變數
+    args = _parse_args(argv)
+    configure_logging(args.log_verbosity, args.log_rotation)
+    try:
+        configure_run(args)
+        if args.daemon:
+            run_daemon(args)
+        else:
+            try:
+                run_sync(args)
+            finally:
+                write_run_metrics(args)
+    finally:
+        close_http_session()
+        close_db_pool()
+        close_login_client()
+        close_state_store()
+        stop_logging()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file